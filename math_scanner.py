@@ -14,39 +14,116 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import cProfile
 from base64 import b64encode
-from io import BytesIO
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import hashlib
+import hmac
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
 import json
+import marshal
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+import os
 from os import path
 import platform
+import pstats
 import requests
+import select
+import socket
+import socketserver
+import struct
 import sys
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlencode, urlparse
+from xml.sax.saxutils import escape, quoteattr
+import zipfile
 
 import appdirs
+import numpy as np
 from PIL import Image, ImageOps
 if platform.system()=="Linux":
     from speechd.client import SSIPClient
 elif platform.system()=="Windows":
     from cytolk import tolk
+if platform.system()!="Windows":
+    import fcntl
 import pytesseract
 import wx
 import yaml
 
 class ImageProcessor:
 
+    BAND_SIZE=4*1024*1024 # Approximate amount of bytes decoded at once when loading large uncompressed images
+    NEAREST_ROTATION_SIZE=3000000 # Pixels of images deskewed without interpolation
+    SKEW_MINIMUM_LINES=3 # Text lines needed to trust the estimated skew
+    SKEW_MINIMUM_INK=0.002 # Share of ink pixels in the sample needed to trust the estimated skew
+    SKEW_MINIMUM_GAIN=1.25 # How much sharper the projection profile at the estimated angle must be than at zero
+
+    def open_image(file_path, config):
+
+        # Image.open reads just the header, so we can decide how to decode the pixels with the working size of the image in mind
+
+        image=Image.open(file_path)
+
+        target_size=ImageProcessor._target_size(image.size, config)
+        if target_size==image.size:
+            image.load() # Uncompressed single-strip images in compatible modes get memory mapped by PIL here
+            return image
+
+        if image.format=="JPEG":
+
+            # JPEG decoder can scale the image by 1/2, 1/4 or 1/8 while decoding. It keeps the size above the requested one, the rest is left to process_image
+
+            image.draft(image.mode, target_size)
+            image.load()
+            return image
+
+        bands=ImageProcessor._raw_bands(image)
+        if bands!=None:
+            return ImageProcessor._decode_in_bands(file_path, image, bands, target_size)
+
+        image.load()
+        return image
     def process_image(image, config):
+
         if not config.active:
             return image
 
+        # The image is fitted first, so the deskewing rotates only the pixels we keep
+
+        if config.maximum_size>0:
+            image=ImageProcessor._fit(image, config.maximum_size)
+
+        skew_angle=None
+        if config.deskew:
+            image, skew_angle=ImageProcessor.deskew(image)
+
         if config.scale_factor!=1:
             image=ImageProcessor._scale(image, config.scale_factor)
         if config.invert:
             image=ImageOps.invert(image)
         if config.grayscale:
             image=ImageOps.grayscale(image)
-        if config.blackwhite_threshold>=0 and config.blackwhite_threshold<256:
+        if config.blackwhite_method=="otsu":
+            image=ImageProcessor._blackwhite(image, ImageProcessor.otsu_threshold(image))
+        elif config.blackwhite_method=="sauvola":
+            image=ImageProcessor._sauvola(image, config.sauvola_window_size, config.sauvola_k)
+        elif config.blackwhite_threshold>=0 and config.blackwhite_threshold<256:
             image=ImageProcessor._blackwhite(image, config.blackwhite_threshold)
 
+        if skew_angle!=None:
+            image.info["skew_angle"]=skew_angle
+
         return image
     def process_image_parameterized(image, scale_factor=1, invert=False, grayscale=False, blackwhite_threshold=-1):
 
@@ -60,25 +137,240 @@ class ImageProcessor:
             image=ImageProcessor._blackwhite(image, blackwhite_threshold)
 
         return image
+    def estimate_skew(image, maximum_angle=5, sample=None):
+
+        # Projection profile search on a downsampled binary image. Ink pixels are projected to rows along lines tilted by the candidate angle, the profile is sharpest (has the biggest differences between neighbouring rows) when the lines follow the text. Returns the counterclockwise angle of the text in degrees
+
+        if sample==None:
+            sample=ImageProcessor._skew_sample(image)
+
+        ink=np.asarray(sample)<128
+        if ink.mean()>0.5:
+            ink=~ink
+
+        # A few lines, like a screenshot of a formula, don't tell the angle reliably, their profile is sharpest at whatever angle lines up the symbols. Such images are left as they are
+
+        if ink.mean()<ImageProcessor.SKEW_MINIMUM_INK:
+            return 0.0
+
+        ys, xs=np.nonzero(ink)
+
+        def profile(angle):
+            rows=np.round(ys+xs*np.tan(np.radians(angle))).astype(np.int64)
+
+            return np.bincount(rows-rows.min())
+        def sharpness(angle):
+            return np.sum(np.diff(profile(angle)).astype(np.float64)**2)
+
+        # Coarse search followed by a finer one around the best candidate, both within the maximum angle
+
+        angles=np.arange(-maximum_angle, maximum_angle+0.25, 0.5)
+        best=max(angles, key=sharpness)
+        angles=np.arange(max(best-0.5, -maximum_angle), min(best+0.5, maximum_angle)+0.05, 0.1)
+        best=max(angles, key=sharpness)
+
+        best_profile=profile(best)
+        lines=np.count_nonzero(np.diff((best_profile>0.2*best_profile.max()).astype(np.int8))==1)
+
+        if lines<ImageProcessor.SKEW_MINIMUM_LINES or sharpness(best)<ImageProcessor.SKEW_MINIMUM_GAIN*sharpness(0):
+            return 0.0
+
+        return round(float(best), 1)+0.0 # Avoids reporting -0.0
+    def deskew(image, maximum_angle=5):
+        sample=ImageProcessor._skew_sample(image)
+        angle=ImageProcessor.estimate_skew(image, maximum_angle, sample)
+
+        if abs(angle)>=0.1:
+            if image.mode not in ("L", "RGB", "RGBA"):
+                image=image.convert("L" if image.mode=="1" else "RGB")
+
+            # The corners uncovered by the rotation get the prevailing colour of the page. Scans of 3 megapixels and more have glyphs tall enough for the nearest neighbour, which is several times faster than interpolation. Smaller images are interpolated bilinearly
+
+            background=255 if np.asarray(sample).mean()>=128 else 0
+            fill_color=background if image.mode=="L" else (background, )*len(image.mode)
+            resample=Image.NEAREST if image.size[0]*image.size[1]>=ImageProcessor.NEAREST_ROTATION_SIZE else Image.BILINEAR
+
+            image=image.rotate(-angle, resample, expand=True, fillcolor=fill_color)
+        else:
+            image=image.copy() # The angle is recorded in the info of the returned image, which mustn't be the caller's
+
+        image.info["skew_angle"]=angle
+
+        return image, angle
+
+    def _skew_sample(image):
+
+        # A grayscale copy fitting to 800 pixels. The integer reduction first keeps the cost low even for huge pages
+
+        if image.mode not in ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK"):
+            image=image.convert("L")
+
+        factor=max(1, max(image.size)//800)
+        sample=ImageOps.grayscale(image.reduce(factor) if factor>1 else image)
+        sample.thumbnail((800, 800))
+
+        return sample
 
     def _scale(image, scale_factor):
         width, height=image.size
 
         return image.resize((width*scale_factor, height*scale_factor), Image.BICUBIC)
+    def _fit(image, maximum_size):
+        target_size=ImageProcessor._fitting_size(image.size, maximum_size)
+
+        return image.resize(target_size, Image.LANCZOS) if target_size!=image.size else image
+    def _fitting_size(size, maximum_size):
+        width, height=size
+
+        if maximum_size<=0 or max(width, height)<=maximum_size:
+            return size
+
+        ratio=maximum_size/max(width, height)
+
+        return (max(1, round(width*ratio)), max(1, round(height*ratio)))
+    def _target_size(size, config):
+        if not config.active:
+            return size
+
+        return ImageProcessor._fitting_size(size, config.maximum_size)
+    def _raw_bands(image):
+
+        # Splits the uncompressed strips of an image to bands, which can be decoded one by one. Returns None if the image has a layout we can't split
+
+        bands=[]
+
+        for decoder, extents, offset, args in image.tile:
+            if decoder!="raw":
+                return None
+
+            if isinstance(args, str):
+                args=(args, )
+            rawmode, stride, orientation=(tuple(args)+(0, 1))[:3]
+
+            if rawmode!=image.mode or rawmode not in ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK") or orientation!=1:
+                return None
+
+            x0, y0, x1, y1=extents
+            if stride==0:
+                stride=(x1-x0)*Image.getmodebands(rawmode)
+
+            band_height=max(16, ImageProcessor.BAND_SIZE//stride)
+
+            for y in range(y0, y1, band_height):
+                bands.append(((x0, y, x1, min(y+band_height, y1)), offset+(y-y0)*stride, (rawmode, stride, 1)))
+
+        return bands
+    def _decode_in_bands(file_path, image, bands, target_size):
+        result=Image.new(image.mode, target_size)
+        x_ratio=target_size[0]/image.size[0]
+        y_ratio=target_size[1]/image.size[1]
+
+        for (x0, y0, x1, y1), offset, args in bands:
+
+            # Each band is decoded as a standalone image reading only its part of the file, scaled down and released
+
+            band=Image.open(file_path)
+            band._size=(x1-x0, y1-y0)
+            band.tile=[("raw", (0, 0, x1-x0, y1-y0), offset, args)]
+            band.load()
+
+            left, top, right, bottom=round(x0*x_ratio), round(y0*y_ratio), round(x1*x_ratio), round(y1*y_ratio)
+            if right>left and bottom>top:
+                result.paste(band.resize((right-left, bottom-top), Image.BOX), (left, top))
+
+            band.close()
+
+        image.close()
+
+        return result
+    def otsu_threshold(image):
+
+        # The threshold maximizing the variance between the dark and light pixels, computed from the histogram in a single pass over its cumulative sums
+
+        histogram=np.bincount(np.asarray(ImageOps.grayscale(image)).ravel(), minlength=256).astype(np.float64)
+        levels=np.arange(256)
+
+        weight_dark=np.cumsum(histogram)
+        weight_light=weight_dark[-1]-weight_dark
+        sum_dark=np.cumsum(histogram*levels)
+        mean_dark=sum_dark/np.maximum(weight_dark, 1)
+        mean_light=(sum_dark[-1]-sum_dark)/np.maximum(weight_light, 1)
+
+        variance=weight_dark*weight_light*(mean_dark-mean_light)**2
+
+        # Pixels under the threshold become black, the best split puts the level itself to the dark class
+
+        return int(np.argmax(variance))+1
+    def _sauvola(image, window_size, k):
+
+        # Local thresholds T=m*(1+k*(s/R-1)) from the mean m and standard deviation s of a window around each pixel, both read from integral images in constant time per pixel
+
+        pixels=np.asarray(ImageOps.grayscale(image))
+        height, width=pixels.shape
+        radius=window_size//2
+
+        # The integrals wrap around in uint32, differences of four corners are still exact as long as a single window sum fits, which the window size limit guarantees
+
+        integral=np.zeros((height+1, width+1), dtype=np.uint32)
+        integral[1:, 1:]=pixels
+        np.cumsum(integral, axis=0, out=integral)
+        np.cumsum(integral, axis=1, out=integral)
+        integral_squares=np.zeros((height+1, width+1), dtype=np.uint32)
+        integral_squares[1:, 1:]=pixels
+        integral_squares*=integral_squares
+        np.cumsum(integral_squares, axis=0, out=integral_squares)
+        np.cumsum(integral_squares, axis=1, out=integral_squares)
+
+        # Clamped column indices laid out so that the right and left corners of every window are two plain slices
+
+        columns=np.clip(np.arange(-radius, width+radius+1), 0, width)
+        column_count=(columns[2*radius+1:]-columns[:width]).astype(np.float32)
+
+        result=np.empty((height, width), dtype=np.uint8)
+        band_height=max(16, ImageProcessor.BAND_SIZE//(4*(width+2*radius+1)))
+
+        for y0 in range(0, height, band_height):
+            y1=min(y0+band_height, height)
+            rows=np.clip(np.arange(y0-radius, y1+radius+1), 0, height)
+            row_count=(rows[2*radius+1:]-rows[:y1-y0]).astype(np.float32)
+            count=row_count[:, np.newaxis]*column_count
+
+            def window_sum(table):
+                vertical=table[rows[2*radius+1:]]-table[rows[:y1-y0]]
+                vertical=vertical[:, columns]
+
+                return (vertical[:, 2*radius+1:]-vertical[:, :width]).astype(np.float32)
+
+            mean=window_sum(integral)/count
+            deviation=np.sqrt(np.maximum(window_sum(integral_squares)/count-mean**2, 0))
+
+            threshold=mean*(1+k*(deviation/128-1))
+            result[y0:y1]=np.where(pixels[y0:y1]<threshold, 0, 255)
+
+        return Image.fromarray(result, "L")
     def _blackwhite(image, threshold):
         return ImageOps.grayscale(image).point(lambda p: 0 if p<threshold else 255)
 class ImageProcessingConfiguration:
 
-    def __init__(self, active=True, scale_factor=1, invert=False, grayscale=False, blackwhite_threshold=-1):
+    def __init__(self, active=True, deskew=False, maximum_size=0, scale_factor=1, invert=False, grayscale=False, blackwhite_threshold=-1, blackwhite_method="fixed", sauvola_window_size=25, sauvola_k=0.2):
 
         self.active=active
+        self.deskew=deskew
+        self.maximum_size=maximum_size
         self.scale_factor=scale_factor
         self.invert=invert
         self.grayscale=grayscale
         self.blackwhite_threshold=blackwhite_threshold
+        self.blackwhite_method=blackwhite_method
+        self.sauvola_window_size=sauvola_window_size
+        self.sauvola_k=sauvola_k
 
     def set_active(self, active):
         self.active=active
+    def set_deskew(self, deskew):
+        self.deskew=deskew
+    def set_maximum_size(self, maximum_size):
+        self.maximum_size=maximum_size
     def set_scale_factor(self, scale_factor):
         self.scale_factor=scale_factor
     def set_invert(self, invert):
@@ -87,13 +379,24 @@ class ImageProcessingConfiguration:
         self.grayscale=grayscale
     def set_blackwhite_threshold(self, blackwhite_threshold):
         self.blackwhite_threshold=blackwhite_threshold
+    def set_blackwhite_method(self, blackwhite_method):
+        blackwhite_method=blackwhite_method.lower()
+
+        if blackwhite_method in ("fixed", "otsu", "sauvola"):
+            self.blackwhite_method=blackwhite_method
+    def set_sauvola_window_size(self, sauvola_window_size):
+        if 3<=sauvola_window_size<=255:
+            self.sauvola_window_size=sauvola_window_size
+    def set_sauvola_k(self, sauvola_k):
+        self.sauvola_k=sauvola_k
 class MathpixConfiguration:
 
-    def __init__(self, app_id=None, app_key=None, formats=["asciimath"]):
+    def __init__(self, app_id=None, app_key=None, formats=["asciimath"], speculative_candidates=0):
 
         self.app_id=app_id
         self.app_key=app_key
         self.formats=["asciimath"]
+        self.speculative_candidates=speculative_candidates
 
         # The formats configuration must be done separately, as otherwise the user could specify invalid input and the property stay undefined
         self.set_formats(formats)
@@ -108,6 +411,9 @@ class MathpixConfiguration:
             self.app_key=None
         else:
             self.app_key=app_key
+    def set_speculative_candidates(self, speculative_candidates):
+        if speculative_candidates>=0:
+            self.speculative_candidates=speculative_candidates
     def set_formats(self, formats):
 
         i=0
@@ -124,10 +430,12 @@ class MathpixConfiguration:
             self.formats=formats
 class TesseractConfiguration:
 
-    def __init__(self, data_directory=None, recognition_language="eng", ocr_engine_mode=3):
+    def __init__(self, data_directory=None, recognition_language="eng", ocr_engine_mode=3, refinement_scale_factor=3, worker_processes=0):
         self.data_directory=data_directory
         self.recognition_language=recognition_language
         self.ocr_engine_mode=ocr_engine_mode
+        self.refinement_scale_factor=refinement_scale_factor
+        self.worker_processes=worker_processes
 
     def set_data_directory(self, data_directory):
         self.data_directory=data_directory if data_directory!="default" else None
@@ -135,6 +443,12 @@ class TesseractConfiguration:
         self.recognition_language=recognition_language
     def set_ocr_engine_mode(self, ocr_engine_mode):
         self.ocr_engine_mode=ocr_engine_mode
+    def set_refinement_scale_factor(self, refinement_scale_factor):
+        if refinement_scale_factor>=1:
+            self.refinement_scale_factor=refinement_scale_factor
+    def set_worker_processes(self, worker_processes):
+        if worker_processes>=0:
+            self.worker_processes=worker_processes
 
     def generate_shell_configuration(self):
         result=[]
@@ -146,14 +460,127 @@ class TesseractConfiguration:
 
         return " ".join(result)
 
+class DaemonConfiguration:
+
+    def __init__(self, use_daemon=False, socket_path="default", host="127.0.0.1", port=8765, token=None, workers=2, cache_size=256):
+        self.use_daemon=use_daemon
+        self.socket_path=None
+        self.host=host
+        self.port=port
+        self.token=token
+        self.workers=workers
+        self.cache_size=cache_size
+
+        self.set_socket_path(socket_path)
+
+    def set_use_daemon(self, use_daemon):
+        self.use_daemon=use_daemon
+    def set_socket_path(self, socket_path):
+
+        # Systems with unix sockets use one by default, none switches to the TCP port
+
+        if socket_path=="default":
+            self.socket_path=path.join(appdirs.user_cache_dir("math_scanner"), "daemon.socket") if hasattr(socket, "AF_UNIX") and platform.system()!="Windows" else None
+        elif socket_path=="none":
+            self.socket_path=None
+        else:
+            self.socket_path=socket_path
+    def set_token(self, token):
+        self.token=token if token!="" else None
+    def set_host(self, host):
+        self.host=host
+    def set_port(self, port):
+        self.port=port
+    def set_workers(self, workers):
+        if workers>0:
+            self.workers=workers
+    def set_cache_size(self, cache_size):
+        if cache_size>=0:
+            self.cache_size=cache_size
+
+class CacheConfiguration:
+
+    def __init__(self, page_cache=True, near_duplicates=True, directory=None, size=2000):
+        self.page_cache=page_cache
+        self.near_duplicates=near_duplicates
+        self.directory=directory
+        self.size=size
+
+    def set_page_cache(self, page_cache):
+        self.page_cache=page_cache
+    def set_near_duplicates(self, near_duplicates):
+        self.near_duplicates=near_duplicates
+    def set_directory(self, directory):
+        self.directory=directory if directory!="default" else None
+    def set_size(self, size):
+        if size>=1:
+            self.size=size
+
+class MemoryConfiguration:
+
+    def __init__(self, soft_budget=0, trace=False):
+        self.soft_budget=soft_budget
+        self.trace=trace
+
+    def set_soft_budget(self, soft_budget):
+        if soft_budget>=0:
+            self.soft_budget=soft_budget
+    def set_trace(self, trace):
+        self.trace=trace
+
+class RecognitionConfiguration:
+
+    def __init__(self, local_first=False, local_language="eng", minimum_confidence=0.9, mathpix_price=0.004):
+        self.local_first=local_first
+        self.local_language=local_language
+        self.minimum_confidence=minimum_confidence
+        self.mathpix_price=mathpix_price
+
+    def set_local_first(self, local_first):
+        self.local_first=local_first
+    def set_local_language(self, local_language):
+        self.local_language=local_language
+    def set_minimum_confidence(self, minimum_confidence):
+        if minimum_confidence>=0 and minimum_confidence<=1:
+            self.minimum_confidence=minimum_confidence
+    def set_mathpix_price(self, mathpix_price):
+        if mathpix_price>=0:
+            self.mathpix_price=mathpix_price
+
+class SchedulerConfiguration:
+
+    def __init__(self, workers=4, visible_next_limit=3, prefetch_limit=1, batch_limit=1):
+        self.workers=workers
+        self.visible_next_limit=visible_next_limit
+        self.prefetch_limit=prefetch_limit
+        self.batch_limit=batch_limit
+
+    def set_workers(self, workers):
+        if workers>=2:
+            self.workers=workers
+    def set_visible_next_limit(self, visible_next_limit):
+        if visible_next_limit>=1:
+            self.visible_next_limit=visible_next_limit
+    def set_prefetch_limit(self, prefetch_limit):
+        if prefetch_limit>=1:
+            self.prefetch_limit=prefetch_limit
+    def set_batch_limit(self, batch_limit):
+        if batch_limit>=1:
+            self.batch_limit=batch_limit
+
 class Settings:
 
     def __init__(self):
 
         self.mathpix_configuration=MathpixConfiguration()
         self.tesseract_configuration=TesseractConfiguration()
-        self.input_image_processing_configuration=ImageProcessingConfiguration(active=False)
+        self.input_image_processing_configuration=ImageProcessingConfiguration(active=False, deskew=True)
         self.output_image_processing_configuration=ImageProcessingConfiguration(active=False)
+        self.daemon_configuration=DaemonConfiguration()
+        self.cache_configuration=CacheConfiguration()
+        self.memory_configuration=MemoryConfiguration()
+        self.recognition_configuration=RecognitionConfiguration()
+        self.scheduler_configuration=SchedulerConfiguration()
 
         self._setting_getter_result=None # A helper variable for retrieving settings from configuration file
 
@@ -164,23 +591,120 @@ class Settings:
 
             if self._get_mathpix_configuration(doc, "mathpix"): self.mathpix_configuration=self._setting_getter_result
             if self._get_tesseract_configuration(doc, "tesseract"): self.tesseract_configuration=self._setting_getter_result
-            if self._get_image_processing_configuration(doc, "input image processing"): self.input_image_processing_configuration=self._setting_getter_result
+            if self._get_image_processing_configuration(doc, "input image processing", deskew=True): self.input_image_processing_configuration=self._setting_getter_result
             if self._get_image_processing_configuration(doc, "output image processing"): self.output_image_processing_configuration=self._setting_getter_result
+            if self._get_daemon_configuration(doc, "daemon"): self.daemon_configuration=self._setting_getter_result
+            if self._get_cache_configuration(doc, "cache"): self.cache_configuration=self._setting_getter_result
+            if self._get_memory_configuration(doc, "memory"): self.memory_configuration=self._setting_getter_result
+            if self._get_recognition_configuration(doc, "recognition"): self.recognition_configuration=self._setting_getter_result
+            if self._get_scheduler_configuration(doc, "scheduler"): self.scheduler_configuration=self._setting_getter_result
+    def load_from_default_locations(self):
+        candidates=[
+            path.join(appdirs.user_config_dir("math_scanner"), "settings.yaml"),
+            "settings.yaml",
+            ]
+
+        for p in candidates:
+            if path.exists(p):
+                self.load(p)
+                break
+
+    def _get_memory_configuration(self, yaml_node, key_name):
+        if key_name in yaml_node:
+            result=MemoryConfiguration()
+            memory_node=yaml_node[key_name]
+
+            if self._get_int(memory_node, "soft budget"): result.set_soft_budget(self._setting_getter_result)
+            if self._get_bool(memory_node, "trace"): result.set_trace(self._setting_getter_result)
+
+            self._setting_getter_result=result
+
+            return True
+
+        return False
+    def _get_scheduler_configuration(self, yaml_node, key_name):
+        if key_name in yaml_node:
+            result=SchedulerConfiguration()
+            scheduler_node=yaml_node[key_name]
+
+            if self._get_int(scheduler_node, "workers"): result.set_workers(self._setting_getter_result)
+            if self._get_int(scheduler_node, "visible next limit"): result.set_visible_next_limit(self._setting_getter_result)
+            if self._get_int(scheduler_node, "prefetch limit"): result.set_prefetch_limit(self._setting_getter_result)
+            if self._get_int(scheduler_node, "batch limit"): result.set_batch_limit(self._setting_getter_result)
+
+            self._setting_getter_result=result
+
+            return True
+
+        return False
+    def _get_recognition_configuration(self, yaml_node, key_name):
+        if key_name in yaml_node:
+            result=RecognitionConfiguration()
+            recognition_node=yaml_node[key_name]
+
+            if self._get_bool(recognition_node, "local first"): result.set_local_first(self._setting_getter_result)
+            if self._get_str(recognition_node, "local language"): result.set_local_language(self._setting_getter_result)
+            if self._get_float(recognition_node, "minimum confidence"): result.set_minimum_confidence(self._setting_getter_result)
+            if self._get_float(recognition_node, "mathpix price"): result.set_mathpix_price(self._setting_getter_result)
+
+            self._setting_getter_result=result
+
+            return True
+
+        return False
+    def _get_cache_configuration(self, yaml_node, key_name):
+        if key_name in yaml_node:
+            result=CacheConfiguration()
+            cache_node=yaml_node[key_name]
+
+            if self._get_bool(cache_node, "page cache"): result.set_page_cache(self._setting_getter_result)
+            if self._get_bool(cache_node, "near duplicates"): result.set_near_duplicates(self._setting_getter_result)
+            if self._get_str(cache_node, "directory"): result.set_directory(self._setting_getter_result)
+            if self._get_int(cache_node, "size"): result.set_size(self._setting_getter_result)
+
+            self._setting_getter_result=result
+
+            return True
+
+        return False
+    def _get_daemon_configuration(self, yaml_node, key_name):
+        if key_name in yaml_node:
+            result=DaemonConfiguration()
+            daemon_node=yaml_node[key_name]
+
+            if self._get_bool(daemon_node, "use daemon"): result.set_use_daemon(self._setting_getter_result)
+            if self._get_str(daemon_node, "socket"): result.set_socket_path(self._setting_getter_result)
+            if self._get_str(daemon_node, "host"): result.set_host(self._setting_getter_result)
+            if self._get_int(daemon_node, "port"): result.set_port(self._setting_getter_result)
+            if self._get_str(daemon_node, "token"): result.set_token(self._setting_getter_result)
+            if self._get_int(daemon_node, "workers"): result.set_workers(self._setting_getter_result)
+            if self._get_int(daemon_node, "cache size"): result.set_cache_size(self._setting_getter_result)
+
+            self._setting_getter_result=result
+
+            return True
 
-    def _get_image_processing_configuration(self, yaml_node, key_name):
+        return False
+    def _get_image_processing_configuration(self, yaml_node, key_name, deskew=False):
         if key_name in yaml_node:
-            result=ImageProcessingConfiguration()
+            result=ImageProcessingConfiguration(deskew=deskew) # Sections without the deskew option keep the default of the section
             ipc_node=yaml_node[key_name]
 
             if self._get_bool(ipc_node, "active"): result.set_active(self._setting_getter_result)
+            if self._get_bool(ipc_node, "deskew"): result.set_deskew(self._setting_getter_result)
+            if self._get_int(ipc_node, "maximum size"): result.set_maximum_size(self._setting_getter_result)
             if self._get_int(ipc_node, "scale factor"): result.set_scale_factor(self._setting_getter_result)
             if self._get_bool(ipc_node, "invert"): result.set_invert(self._setting_getter_result)
             if self._get_bool(ipc_node, "grayscale"): result.set_grayscale(self._setting_getter_result)
             if self._get_bool(ipc_node, "blackwhite"):
                 if self._setting_getter_result==True:
                     if self._get_int(ipc_node, "blackwhite threshold"): result.set_blackwhite_threshold(self._setting_getter_result)
+                    if self._get_str(ipc_node, "blackwhite method"): result.set_blackwhite_method(self._setting_getter_result)
+                    if self._get_int(ipc_node, "sauvola window size"): result.set_sauvola_window_size(self._setting_getter_result)
+                    if self._get_float(ipc_node, "sauvola k"): result.set_sauvola_k(self._setting_getter_result)
                 else:
                     result.set_blackwhite_threshold(-1)
+                    result.set_blackwhite_method("fixed")
 
             self._setting_getter_result=result
 
@@ -195,6 +719,7 @@ class Settings:
             if self._get_str(mathpix_node, "app id"): result.set_app_id(self._setting_getter_result)
             if self._get_str(mathpix_node, "app key"): result.set_app_key(self._setting_getter_result)
             if self._get_list(mathpix_node, "formats"): result.set_formats(self._setting_getter_result)
+            if self._get_int(mathpix_node, "speculative candidates"): result.set_speculative_candidates(self._setting_getter_result)
 
             self._setting_getter_result=result
 
@@ -209,6 +734,8 @@ class Settings:
             if self._get_str(tc_node, "data directory"): result.set_data_directory(self._setting_getter_result)
             if self._get_str(tc_node, "recognition language"): result.set_recognition_language(self._setting_getter_result)
             if self._get_int(tc_node, "ocr engine mode"): result.set_ocr_engine_mode(self._setting_getter_result)
+            if self._get_int(tc_node, "refinement scale factor"): result.set_refinement_scale_factor(self._setting_getter_result)
+            if self._get_int(tc_node, "worker processes"): result.set_worker_processes(self._setting_getter_result)
 
             self._setting_getter_result=result
 
@@ -226,6 +753,12 @@ class Settings:
             self._setting_getter_result=yaml_node[key_name]
             return True
 
+        return False
+    def _get_float(self, yaml_node, key_name):
+        if key_name in yaml_node and isinstance(yaml_node[key_name], (int, float)) and not isinstance(yaml_node[key_name], bool):
+            self._setting_getter_result=float(yaml_node[key_name])
+            return True
+
         return False
     def _get_list(self, yaml_node, key_name):
         if key_name in yaml_node and isinstance(yaml_node[key_name], list):
@@ -240,6 +773,45 @@ class Settings:
 
         return False
 
+class ImageRegion:
+
+    @property
+    def image(self): return self._image
+
+    @property
+    def box(self):
+        return (self._left, self._top, self._right, self._bottom)
+
+    @property
+    def size(self):
+        return (self._right-self._left, self._bottom-self._top)
+
+    def __init__(self, image, box=None):
+
+        self._image=image
+        self._left, self._top, self._right, self._bottom=box if box!=None else (0, 0, image.size[0], image.size[1])
+
+    def crop(self, box):
+
+        # The box is given in coordinates of this region, but the new view always refers to the root image, so nested crops never copy pixels
+
+        left, top, right, bottom=box
+
+        return ImageRegion(self._image, (self._left+left, self._top+top, self._left+right, self._top+bottom))
+    def materialize(self):
+
+        # A region covering the whole image doesn't need a copy. The caller is expected to drop the result once done with it
+
+        if self.box==(0, 0, self._image.size[0], self._image.size[1]):
+            return self._image
+
+        return self._image.crop(self.box)
+    def save(self, fp, format=None):
+        self.materialize().save(fp, format=format)
+
+    def memory_usage(self):
+        return sys.getsizeof(self)+sys.getsizeof(self.__dict__)
+
 class CharacterBox:
 
     @property
@@ -277,10 +849,15 @@ class CharacterBox:
             return CharacterBox(l[0], int(l[1]), int(l[2]), int(l[3]), int(l[4]))
         else:
             raise ValueError(f"CharacterBox can't be constructed from list of {len(l)} elements.")
+    def to_list(self):
+        return [self._character, self._bottom_left_x, self._bottom_left_y, self._top_right_x, self._top_right_y]
 
     def is_on_line(self, line_y):
         return line_y>=self._bottom_left_y and line_y<=self._top_right_y
 
+    def memory_usage(self):
+        return sys.getsizeof(self)+sys.getsizeof(self.__dict__)
+
 def segment_image(image, tesseract_configuration):
 
     # First, recognize the input image and parse the bounding boxes of individual characters. We currently don't need the page number entry, so will take just the first 5 entries of each row of image_to_boxes.
@@ -355,365 +932,2793 @@ def segment_image(image, tesseract_configuration):
     # And now add spaces
 
     for line in lines.values():
+        insert_spaces(line, space_width)
 
-        # We again have to deal with Python's inability to modify for driver variable
+    result=[i for i in lines.keys()]
+    result.sort(reverse=True)
+    result=[lines[line] for line in result]
 
-        i=0
-        while i<len(line)-1:
-            ch_1=line[i]
-            ch_2=line[i+1]
+    return result
 
-            characters_distance=ch_2.bottom_left_x-ch_1.top_right_x
+class SharedImage:
 
-            if characters_distance>=space_width:
-                space_character=CharacterBox(" ", ch_1.top_right_x, ch_1.bottom_left_y, ch_2.bottom_left_x, ch_2.top_right_y)
-                line.insert(i+1, space_character)
+    # A handle of an image in shared memory, or of a rectangle of it. It's tiny, so passing it to a worker process costs nearly nothing, and the worker reads the pixels in place
 
-                i+=1
+    def __init__(self, name, mode, size, box=None):
+        self.name=name
+        self.mode=mode
+        self.size=size # Of the whole stored image
+        self.box=box if box!=None else (0, 0, size[0], size[1])
 
-            i+=1
+    def crop(self, box):
+        left, top, _, _=self.box
 
-    result=[i for i in lines.keys()]
-    result.sort(reverse=True)
-    result=[lines[line] for line in result]
+        return SharedImage(self.name, self.mode, self.size, (left+box[0], top+box[1], left+box[2], top+box[3]))
 
-    return result
+    def open(self, memory):
 
-class MathpixRecognizer:
+        # Returns the image of the rectangle, sharing the pixels of the attached memory. It must be dropped before the memory is closed
 
-    def __init__(self, configuration=None):
+        pixel_size=4 if self.mode=="RGBX" else 1
+        left, top, right, bottom=self.box
 
-        self._configuration=MathpixConfiguration()
+        return Image.frombuffer(self.mode, (right-left, bottom-top), memory.buf[(top*self.size[0]+left)*pixel_size:], "raw", self.mode, self.size[0]*pixel_size, 1)
 
-        self.configure(configuration)
+class SharedImageStore:
 
-    def configure(self, configuration):
-        if configuration!=None:
-            self._configuration=configuration
+    # Owns images copied to shared memory blocks. Blocks live until released, closing the store releases all of them. Pixels are kept as L or RGBX, the modes PIL can map without copying
 
-    def recognize(self, image):
+    def __init__(self):
+        self._blocks={} # Names: shared memory blocks
 
-        assert self._configuration.app_id!=None
-        assert self._configuration.app_key!=None
+    def put(self, image):
+        if image.mode not in ("1", "L"):
+            image=image.convert("RGB")
+        mode="L" if image.mode in ("1", "L") else "RGBX"
+        channels=1 if mode=="L" else 4
+        width, height=image.size
 
-        png_stream=BytesIO()
-        image.save(png_stream, format="png")
-        png_stream.seek(0)
+        # PIL checks that a buffer holds whole rows, so a rectangle reaching the end of the image needs one spare row
 
-        png_b64=b64encode(png_stream.read()).decode("utf-8")
+        memory=shared_memory.SharedMemory(create=True, size=max(width*(height+1)*channels, 1))
+        pixels=np.ndarray((height+1, width, channels), dtype=np.uint8, buffer=memory.buf)
 
-        png_stream.close()
+        source=np.asarray(image)
+        if image.mode=="1":
+            source=source.astype(np.uint8)*255
+        pixels[:height, :, :3 if channels==4 else 1]=source.reshape(height, width, -1)
+        if channels==4:
+            pixels[:height, :, 3]=255
+        del pixels
 
-        # We have the image in a base64 encoding, now it's time to call the server
+        self._blocks[memory.name]=memory
 
-        service="https://api.mathpix.com/v3/latex"
+        return SharedImage(memory.name, mode, image.size)
+    def release(self, handle):
+        memory=self._blocks.pop(handle.name, None)
+        if memory!=None:
+            memory.close()
+            memory.unlink()
+    def close(self):
+        for memory in self._blocks.values():
+            memory.close()
+            memory.unlink()
 
-        headers={
-            "app_id": self._configuration.app_id,
-            "app_key": self._configuration.app_key,
-            "Content-type": "application/json",
-            }
+        self._blocks={}
 
-        args=json.dumps({
-            "src": f"data:image/png;base64,{png_b64}",
-            "formats": self._configuration.formats,
-            })
+    def memory_usage(self):
+        return sum([memory.size for memory in self._blocks.values()])
 
-        result=requests.post(service, headers=headers, data=args, timeout=30)
+def segment_shared_image(handle, tesseract_configuration):
 
-        return result.text
+    # Runs in a worker process, recognizing the image in shared memory
 
-class MathScanner:
+    memory=shared_memory.SharedMemory(handle.name)
+    image=None
 
-    @property
-    def file_name(self): return self._file_name
+    try:
+        image=handle.open(memory)
 
-    @property
-    def image(self):
-        return self._image if not self.has_columns else self._columns[self._active_column_index][0]
+        return segment_image(image, tesseract_configuration)
+    finally:
+        image=None
+        memory.close()
 
-    @property
-    def image_boxes(self):
-        return self._image_boxes if not self.has_columns else self._columns[self._active_column_index][1]
+def boxes_memory_usage(boxes):
+    return sys.getsizeof(boxes)+sum([sys.getsizeof(line)+sum([ch.memory_usage() for ch in line]) for line in boxes])
+def image_memory_usage(image):
 
-    @property
-    def image_text(self):
-        return self._image_text if not self.has_columns else self._columns[self._active_column_index][2]
+    # PIL stores pixels of most multi-band modes in 4 bytes
 
-    @property
-    def active_column_index(self): return self._active_column_index
+    if image==None:
+        return 0
 
-    @property
-    def column_count(self): return len(self._columns)
+    pixel_size={"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2}.get(image.mode, 4)
 
-    @property
-    def has_columns(self):
-        return len(self._columns)>0
+    return image.size[0]*image.size[1]*pixel_size
+def format_memory_size(size):
+    for unit in ("bytes", "kB", "MB"):
+        if size<1024:
+            return f"{size:.0f} {unit}" if unit=="bytes" else f"{size:.1f} {unit}"
+        size/=1024
 
-    def __init__(self, settings):
+    return f"{size:.1f} GB"
 
-        self._file_name="Untitled"
-        self._image=None
-        self._image_text=""
-        self._image_boxes=[]
+def boxes_to_list(boxes):
+    return [[ch.to_list() for ch in line] for line in boxes]
+def boxes_from_list(l):
+    return [[CharacterBox.from_list(ch) for ch in line] for line in l]
 
-        self._left_border=None
-        self._right_border=None
-        self._top_border=None
-        self._bottom_border=None
+def insert_spaces(line, space_width=10):
 
-        self._columns=[]
-        self._active_column_index=0
+    # We again have to deal with Python's inability to modify for driver variable
 
-        self._settings=settings
-        self._mathpix_recognizer=MathpixRecognizer(settings.mathpix_configuration)
+    i=0
+    while i<len(line)-1:
+        ch_1=line[i]
+        ch_2=line[i+1]
 
-    def load_image_from_file(self, path):
-        self._image=ImageProcessor.process_image(Image.open(path), self._settings.input_image_processing_configuration)
-        self._file_name=path.split("/")[-1]
-        self._image_boxes=segment_image(self._image, self._settings.tesseract_configuration)
-        self._image_text="\n".join(["".join([ch.character for ch in l]) for l in self._image_boxes])
+        characters_distance=ch_2.bottom_left_x-ch_1.top_right_x
 
-        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
-        self._columns=[]
-        self._active_column_index=0
+        if characters_distance>=space_width:
+            space_character=CharacterBox(" ", ch_1.top_right_x, ch_1.bottom_left_y, ch_2.bottom_left_x, ch_2.top_right_y)
+            line.insert(i+1, space_character)
 
-    def place_left_border(self, row, column):
+            i+=1
 
-        self._check_coordinates(row, column)
+        i+=1
 
-        border=self.image_boxes[row][column]._bottom_left_x
+def ink_profile(image):
 
-        if self._left_border==None or border<self._left_border:
-            self._left_border=border
+    # For every column of pixels, computes the fraction of rows containing ink. Pages with light text on dark background are recognized by the prevailing colour
 
-            return True
+    pixels=np.asarray(ImageOps.grayscale(image))
+    ink=pixels<128
+    if ink.mean()>0.5:
+        ink=~ink
 
-        return False
-    def place_right_border(self, row, column):
+    return ink.mean(axis=0) if ink.shape[0]>0 else np.zeros(ink.shape[1])
+def boxes_profile(boxes, width):
 
-        self._check_coordinates(row, column)
+    # For every column of pixels, computes the fraction of text lines having a character crossing it
 
-        border=self.image_boxes[row][column]._top_right_x
+    coverage=np.zeros(width)
+
+    for line in boxes:
+        line_coverage=np.zeros(width, dtype=bool)
+        for ch in line:
+            if ch.character!=" ":
+                line_coverage[max(ch.bottom_left_x, 0):max(ch.top_right_x, 0)]=True
+        coverage+=line_coverage
+
+    return coverage/len(boxes) if len(boxes)>0 else coverage
+def find_column_gutters(profile, minimum_width=None, tolerance=0.05):
+
+    # Gutters are runs of (nearly) empty columns of pixels between the first and last inked ones. A bit of ink is tolerated, so headings spanning multiple columns don't hide the gutter below them. Returns the middles of the found gutters
+
+    if minimum_width==None:
+        minimum_width=max(8, len(profile)//50)
+
+    empty=profile<=tolerance
+    inked=np.flatnonzero(~empty)
+    if len(inked)==0:
+        return []
+
+    # Edges of runs of empty columns, limited to the text extents
+
+    inner=empty[inked[0]:inked[-1]+1].astype(np.int8)
+    edges=np.diff(np.concatenate(([0], inner, [0])))
+    starts=np.flatnonzero(edges==1)
+    ends=np.flatnonzero(edges==-1)
+
+    return [int(inked[0]+(start+end)//2) for start, end in zip(starts, ends) if end-start>=minimum_width]
+
+class LayoutMap:
+
+    # Geometry of a page or column, computed once from its boxes, so that questions about the layout are just lookups. Boxes of all characters are kept in flat arrays, the characters of a line starting at its offset. Lines get their extents, baseline, median glyph height, the gap to the previous line and the indentation level. All y coordinates are measured from the bottom, as Tesseract does
+
+    def __init__(self, boxes, size):
+
+        self.size=size
+
+        lengths=np.array([len(line) for line in boxes], dtype=np.int64)
+        self.offsets=np.concatenate(([0], np.cumsum(lengths)))
+
+        characters=[ch for line in boxes for ch in line]
+        coordinates=np.array([(ch.bottom_left_x, ch.bottom_left_y, ch.top_right_x, ch.top_right_y) for ch in characters], dtype=np.int64).reshape(-1, 4)
+        self.left, self.bottom, self.right, self.top=coordinates.T
+
+        # Spaces have boxes spanning the gaps between words, only the other characters count for lines
+
+        ink=np.array([ch.character!=" " for ch in characters], dtype=bool)
+        rows=np.repeat(np.arange(len(boxes)), lengths)[ink]
+        line_count=len(boxes)
+
+        self.line_left=np.full(line_count, np.inf)
+        self.line_right=np.full(line_count, -np.inf)
+        self.line_top=np.full(line_count, -np.inf)
+        self.line_bottom=np.full(line_count, np.inf)
+        np.minimum.at(self.line_left, rows, self.left[ink])
+        np.maximum.at(self.line_right, rows, self.right[ink])
+        np.maximum.at(self.line_top, rows, self.top[ink])
+        np.minimum.at(self.line_bottom, rows, self.bottom[ink])
+
+        heights=self.top-self.bottom
+        self.baseline=np.array([np.median(self.bottom[self.offsets[i]:self.offsets[i+1]][ink[self.offsets[i]:self.offsets[i+1]]]) if np.any(ink[self.offsets[i]:self.offsets[i+1]]) else np.nan for i in range(line_count)])
+        self.line_height=np.array([np.median(heights[self.offsets[i]:self.offsets[i+1]][ink[self.offsets[i]:self.offsets[i+1]]]) if np.any(ink[self.offsets[i]:self.offsets[i+1]]) else np.nan for i in range(line_count)])
+
+        # Gaps and spacing belong to the line below, the first line has none
+
+        self.gap=np.concatenate(([np.nan], self.line_bottom[:-1]-self.line_top[1:])) if line_count>0 else np.zeros(0)
+        self.spacing=np.concatenate(([np.nan], self.baseline[:-1]-self.baseline[1:])) if line_count>0 else np.zeros(0)
+
+        finite_heights=self.line_height[np.isfinite(self.line_height)]
+        finite_spacing=self.spacing[np.isfinite(self.spacing)]
+        self.median_height=float(np.median(finite_heights)) if len(finite_heights)>0 else 0.0
+        self.median_spacing=float(np.median(finite_spacing)) if len(finite_spacing)>0 else 0.0
+
+        # Left edges of lines closer than a glyph height belong to the same indentation. Levels start with 0 at the leftmost one, lines without characters have -1
+
+        self.level=np.full(line_count, -1, dtype=np.int64)
+        inked_lines=np.flatnonzero(np.isfinite(self.line_left))
+        if len(inked_lines)>0:
+            lefts=np.sort(self.line_left[inked_lines])
+            starts=np.concatenate(([0], np.flatnonzero(np.diff(lefts)>max(self.median_height, 1))+1))
+            self.indentations=[float(cluster.mean()) for cluster in np.split(lefts, starts[1:])]
+            self.level[inked_lines]=np.searchsorted(lefts[starts], self.line_left[inked_lines], side="right")-1
+        else:
+            self.indentations=[]
+
+        width, height=size
+        self.margins=(
+            float(self.line_left.min()) if len(inked_lines)>0 else 0.0,
+            float(width-self.line_right.max()) if len(inked_lines)>0 else 0.0,
+            float(height-self.line_top.max()) if len(inked_lines)>0 else 0.0,
+            float(self.line_bottom.min()) if len(inked_lines)>0 else 0.0,
+            )
+
+    def character(self, row, column):
+
+        # Returns the left, bottom, right and top of the character
+
+        i=self.offsets[row]+column
+
+        return self.left[i], self.bottom[i], self.right[i], self.top[i]
+
+class FormulaCandidate:
+
+    def __init__(self, score, first_row, last_row, left, right, top, bottom):
+
+        self.score=score
+        self.first_row=first_row
+        self.last_row=last_row
+
+        # Edges of the region in Tesseract coordinates, usable directly as borders
+
+        self.left=left
+        self.right=right
+        self.top=top
+        self.bottom=bottom
+
+def find_formula_candidates(boxes, threshold=1.0):
+
+    # Scores each line by signals typical for mathematics: characters other than letters, digits and punctuation, varying glyph heights, small glyphs of indices and exponents, uneven baseline and unusual space around the line. Neighbouring lines scoring above the threshold are merged to a single candidate. Returns the candidates from the most promising one
+
+    characters=[(row, ch) for row, line in enumerate(boxes) for ch in line if ch.character!=" "]
+    if len(characters)==0:
+        return []
+
+    rows=np.array([row for row, _ in characters])
+    heights=np.array([ch.height for _, ch in characters], dtype=np.float64)
+    bottoms=np.array([ch.bottom_left_y for _, ch in characters], dtype=np.float64)
+    symbols=np.array([not (ch.character.isalnum() or ch.character in ".,;:!?'\"") for _, ch in characters], dtype=np.float64)
+
+    line_count=len(boxes)
+    counts=np.maximum(np.bincount(rows, minlength=line_count), 1)
+
+    def line_mean(values):
+        return np.bincount(rows, weights=values, minlength=line_count)/counts
+
+    median_height=max(np.median(heights), 1)
+
+    symbol_density=line_mean(symbols)
+    height_mean=line_mean(heights)
+    height_variation=np.sqrt(np.maximum(line_mean(heights**2)-height_mean**2, 0))/median_height
+    small_glyphs=line_mean((heights<0.6*median_height).astype(np.float64))
+    bottom_mean=line_mean(bottoms)
+    baseline_jitter=np.sqrt(np.maximum(line_mean(bottoms**2)-bottom_mean**2, 0))/median_height
+
+    # Display formulas are usually separated by more space than the lines of text
+
+    line_top=np.full(line_count, -np.inf)
+    line_bottom=np.full(line_count, np.inf)
+    np.maximum.at(line_top, rows, [ch.top_right_y for _, ch in characters])
+    np.minimum.at(line_bottom, rows, bottoms)
+
+    gaps=line_bottom[:-1]-line_top[1:]
+    finite_gaps=gaps[np.isfinite(gaps)]
+    median_gap=max(np.median(finite_gaps), 1) if len(finite_gaps)>0 else 1
+    spacing=np.zeros(line_count)
+    if line_count>1:
+        relative_gaps=np.where(np.isfinite(gaps), gaps/median_gap, 1)
+        spacing[:-1]+=np.clip(relative_gaps-1.5, 0, 3)/2
+        spacing[1:]+=np.clip(relative_gaps-1.5, 0, 3)/2
+
+    scores=3*symbol_density+height_variation+2*small_glyphs+baseline_jitter+0.5*spacing
+    scores[np.bincount(rows, minlength=line_count)==0]=0
+
+    candidates=[]
+    row=0
+    while row<line_count:
+        if scores[row]<threshold:
+            row+=1
+            continue
+
+        first_row=row
+        while row+1<line_count and scores[row+1]>=threshold:
+            row+=1
+
+        selected=[ch for r, ch in characters if r>=first_row and r<=row]
+        candidates.append(FormulaCandidate(
+            float(scores[first_row:row+1].max()), first_row, row,
+            min([ch.bottom_left_x for ch in selected]), max([ch.top_right_x for ch in selected]),
+            max([ch.top_right_y for ch in selected]), min([ch.bottom_left_y for ch in selected]),
+            ))
+        row+=1
+
+    candidates.sort(key=lambda candidate: candidate.score, reverse=True)
+
+    return candidates
+
+class MathpixRecognizer:
+
+    def __init__(self, configuration=None):
+
+        self._configuration=MathpixConfiguration()
+
+        self.configure(configuration)
+
+    def configure(self, configuration):
+        if configuration!=None:
+            self._configuration=configuration
+
+    def recognize(self, image):
+
+        assert self._configuration.app_id!=None
+        assert self._configuration.app_key!=None
+
+        png_stream=BytesIO()
+        image.save(png_stream, format="png")
+        png_stream.seek(0)
+
+        png_b64=b64encode(png_stream.read()).decode("utf-8")
+
+        png_stream.close()
+
+        # We have the image in a base64 encoding, now it's time to call the server
+
+        service="https://api.mathpix.com/v3/latex"
+
+        headers={
+            "app_id": self._configuration.app_id,
+            "app_key": self._configuration.app_key,
+            "Content-type": "application/json",
+            }
+
+        args=json.dumps({
+            "src": f"data:image/png;base64,{png_b64}",
+            "formats": self._configuration.formats,
+            })
+
+        result=requests.post(service, headers=headers, data=args, timeout=30)
+
+        return result.text
+
+class TesseractRecognizer:
+
+    # Recognizes a region locally. Tesseract reads just a single line of symbols, so results spanning more lines, like fractions or exponents, get zero confidence. The confidence is the mean of the word confidences, scaled to the 0 to 1 range used by Mathpix
+
+    def __init__(self, tesseract_configuration, language="eng"):
+        self._tesseract_configuration=tesseract_configuration
+        self._language=language
+
+    def recognize(self, image):
+        data=pytesseract.image_to_data(image, lang=self._language, config=f"{self._tesseract_configuration.generate_shell_configuration()} --psm 6", output_type=pytesseract.Output.DICT)
+
+        words=[(text.strip(), float(confidence), (block, paragraph, line)) for text, confidence, block, paragraph, line in zip(data["text"], data["conf"], data["block_num"], data["par_num"], data["line_num"]) if text.strip()!="" and float(confidence)>=0]
+        text=" ".join([word for word, _, _ in words])
+
+        if len(words)>0 and len(set([line for _, _, line in words]))==1:
+            confidence=sum([confidence for _, confidence, _ in words])/len(words)/100
+        else:
+            confidence=0.0
+
+        # The text is plain, not in any of the Mathpix formats
+
+        return json.dumps({"text": text, "confidence": confidence})
+
+class TieredRecognizer:
+
+    # Passes a region through recognizers ordered from the cheapest, returning the first result confident enough. The last tier is always accepted. Any recognizer with a recognize method taking an image and returning a json response can be a tier, the response's confidence key, from 0 to 1, decides the escalation. Requests, their latency and price are counted per tier
+
+    def __init__(self, tiers, minimum_confidence=0.9):
+
+        self._tiers=tiers # Triples of a name, recognizer and price of a request
+        self._minimum_confidence=minimum_confidence
+
+        self._lock=threading.Lock()
+        self._statistics={name: {"requests": 0, "accepted": 0, "escalated": 0, "time": 0.0, "spend": 0.0} for name, _, _ in tiers}
+
+    def recognize(self, image):
+        for i, (name, recognizer, price) in enumerate(self._tiers):
+            last=i==len(self._tiers)-1
+
+            start=time.perf_counter()
+            try:
+                result=recognizer.recognize(image)
+                response=json.loads(result)
+            except (pytesseract.TesseractError, OSError, ValueError):
+                if last:
+                    raise
+                result, response=None, {}
+            duration=time.perf_counter()-start
+
+            accepted=last or ("error" not in response and response.get("confidence", 0)>=self._minimum_confidence)
+
+            with self._lock:
+                statistics=self._statistics[name]
+                statistics["requests"]+=1
+                statistics["time"]+=duration
+                statistics["spend"]+=price
+                statistics["accepted" if accepted else "escalated"]+=1
+
+            if accepted:
+                return json.dumps(dict(response, tier=name)) if len(self._tiers)>1 else result
+    def statistics(self):
+
+        # Per tier counts of requests, accepted and escalated results, average latency in seconds and spend
+
+        with self._lock:
+            return {name: {
+                "requests": statistics["requests"],
+                "accepted": statistics["accepted"],
+                "escalated": statistics["escalated"],
+                "average latency": statistics["time"]/statistics["requests"] if statistics["requests"]>0 else 0.0,
+                "spend": statistics["spend"],
+                } for name, statistics in self._statistics.items()}
+
+def create_recognizer(settings):
+    configuration=settings.recognition_configuration
+    tiers=[("mathpix", MathpixRecognizer(settings.mathpix_configuration), configuration.mathpix_price)]
+
+    if configuration.local_first:
+        tiers.insert(0, ("tesseract", TesseractRecognizer(settings.tesseract_configuration, configuration.local_language), 0.0))
+
+    return TieredRecognizer(tiers, configuration.minimum_confidence)
+
+class ResultCache:
+
+    # A thread-safe least recently used cache of recognition results
+
+    @property
+    def hits(self): return self._hits
+
+    @property
+    def misses(self): return self._misses
+
+    def __init__(self, capacity=256):
+
+        self._capacity=capacity
+        self._items=OrderedDict()
+        self._lock=threading.Lock()
+
+        self._hits=0
+        self._misses=0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self._hits+=1
+
+                return self._items[key]
+
+            self._misses+=1
+
+            return None
+    def put(self, key, value):
+        with self._lock:
+            self._items[key]=value
+            self._items.move_to_end(key)
+
+            while len(self._items)>self._capacity:
+                self._items.popitem(last=False)
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def image_key(image, *parts):
+
+        # Identifies an image by its pixels together with anything else influencing the result, such as the configuration used
+
+        digest=hashlib.sha1()
+        digest.update(f"{image.mode} {image.size} {parts}".encode("utf-8"))
+        digest.update(image.tobytes())
+
+        return digest.hexdigest()
+
+def encode_png(image):
+
+    # Images sent to the daemon are losslessly compressed, with speed preferred over size
+
+    png_stream=BytesIO()
+    image.save(png_stream, format="png", compress_level=1)
+
+    return png_stream.getvalue()
+
+class Scheduler:
+
+    # Runs OCR and recognition jobs on a shared pool of threads. Jobs wait in a queue per priority class and a free worker always takes the oldest job of the most urgent class, so work for the page being read never waits behind speculative or batch jobs, only behind jobs already running. Running jobs can't be interrupted, so each class has a limit of concurrently running jobs, and all background classes together never take more than all workers but one, which stays free for interactive jobs
+
+    INTERACTIVE=0
+    VISIBLE_NEXT=1
+    PREFETCH=2
+    BATCH=3
+
+    CLASS_NAMES=("interactive", "visible next", "prefetch", "batch")
+
+    def __init__(self, workers=4, limits=None):
+
+        # With a single worker, either background jobs would never run or interactive jobs would wait behind them
+
+        if workers<2:
+            raise ValueError("The scheduler needs at least 2 workers.")
+
+        self._limits=limits if limits!=None else [workers]*len(Scheduler.CLASS_NAMES)
+        self._background_limit=workers-1
+
+        self._condition=threading.Condition()
+        self._queues=[deque() for _ in Scheduler.CLASS_NAMES] # Triples of a future, job and the time of submission
+        self._running=[0]*len(Scheduler.CLASS_NAMES)
+        self._completed=[0]*len(Scheduler.CLASS_NAMES)
+        self._wait=[0.0]*len(Scheduler.CLASS_NAMES)
+        self._maximum_wait=[0.0]*len(Scheduler.CLASS_NAMES)
+        self._stopped=False
+
+        self._threads=[threading.Thread(target=self._work, name=f"scheduler {i+1}", daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, priority, function, *args):
+        future=Future()
+
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Can't submit to a stopped scheduler.")
+
+            self._queues[priority].append((future, lambda: function(*args), time.perf_counter()))
+            self._condition.notify()
+
+        return future
+    def promote(self, future, priority):
+
+        # Moves a waiting job to a more urgent class, for example when the user asks for a result being prefetched
+
+        with self._condition:
+            for queue in self._queues[priority+1:]:
+                for entry in queue:
+                    if entry[0] is future:
+                        queue.remove(entry)
+                        self._queues[priority].append(entry)
+                        self._condition.notify()
+
+                        return True
+
+        return False
+    def shutdown(self, wait=True):
+        with self._condition:
+            self._stopped=True
+
+            for queue in self._queues:
+                for future, _, _ in queue:
+                    future.cancel()
+                queue.clear()
+
+            self._condition.notify_all()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def metrics(self):
+
+        # Per class numbers of waiting, running and completed jobs, the average and maximum time in seconds jobs waited in the queue
+
+        with self._condition:
+            return {name: {
+                "waiting": len(self._queues[i]),
+                "running": self._running[i],
+                "completed": self._completed[i],
+                "average wait": self._wait[i]/self._completed[i] if self._completed[i]>0 else 0.0,
+                "maximum wait": self._maximum_wait[i],
+                } for i, name in enumerate(Scheduler.CLASS_NAMES)}
+
+    def _work(self):
+        while True:
+            with self._condition:
+                taken=self._take()
+                while taken==None:
+                    if self._stopped:
+                        return
+
+                    self._condition.wait()
+                    taken=self._take()
+
+            priority, (future, job, submitted)=taken
+            wait=time.perf_counter()-submitted
+
+            try:
+                future.set_result(job())
+            except BaseException as e:
+                future.set_exception(e)
+
+            with self._condition:
+                self._running[priority]-=1
+                self._completed[priority]+=1
+                self._wait[priority]+=wait
+                self._maximum_wait[priority]=max(self._maximum_wait[priority], wait)
+
+                # A freed slot may let a job of a limited class start
+
+                self._condition.notify_all()
+    def _take(self):
+        for priority, queue in enumerate(self._queues):
+            if priority!=Scheduler.INTERACTIVE and sum(self._running[Scheduler.INTERACTIVE+1:])>=self._background_limit:
+                break
+
+            while len(queue)>0 and self._running[priority]<self._limits[priority]:
+                entry=queue.popleft()
+
+                # Cancelled jobs are just dropped
+
+                if entry[0].set_running_or_notify_cancel():
+                    self._running[priority]+=1
+
+                    return priority, entry
+
+        return None
+
+class RecognitionDaemon:
+
+    # Serves segmentation and recognition to thin clients over a local HTTP API, sharing the loaded settings, caches and a bounded pool of workers between all of them.
+    #
+    # The daemon spends its owner's Mathpix credits, so it's reachable only by the owner through a unix socket with 0600 permissions, or over TCP by clients knowing the token. Clients send image data, never paths, so the daemon doesn't read files on their behalf
+
+    @property
+    def address(self): return self._server.server_address
+
+    def __init__(self, settings):
+
+        self._settings=settings
+        configuration=settings.daemon_configuration
+
+        self._ocr_cache=ResultCache(configuration.cache_size)
+        self._mathpix_cache=ResultCache(configuration.cache_size)
+        self._executor=ThreadPoolExecutor(max_workers=configuration.workers)
+        self._recognizer=create_recognizer(settings)
+
+        if configuration.socket_path!=None:
+            self._server=UnixHTTPServer(configuration.socket_path, DaemonRequestHandler)
+        elif configuration.token!=None:
+            self._server=ThreadingHTTPServer((configuration.host, configuration.port), DaemonRequestHandler)
+        else:
+            raise ValueError("The daemon listening on a TCP port needs a token.")
+        self._server.daemon=self
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._executor.shutdown()
+
+            if self._settings.daemon_configuration.socket_path!=None:
+                os.remove(self._settings.daemon_configuration.socket_path)
+    def shutdown(self):
+        self._server.shutdown()
+
+    def segment(self, image):
+        return self._segment_future(image).result()
+    def split(self, image, splits):
+        edges=[0]+splits+[image.size[0]]
+        regions=[ImageRegion(image).crop((edges[i], 0, edges[i+1], image.size[1])).materialize() for i in range(len(edges)-1)]
+
+        futures=[self._segment_future(region) for region in regions]
+
+        return [future.result() for future in futures]
+    def recognize(self, image):
+        key=ResultCache.image_key(image, self._settings.mathpix_configuration.formats)
+
+        result=self._mathpix_cache.get(key)
+        if result==None:
+            result=self._executor.submit(self._recognizer.recognize, image).result()
+
+            # Errors are not cached, so that they can be retried
+
+            if "error" not in json.loads(result):
+                self._mathpix_cache.put(key, result)
+
+        return result
+    def _segment_future(self, image):
+
+        # Workers never wait for each other, so a request splitting to more columns than there are workers can't exhaust the pool
+
+        key=ResultCache.image_key(image, self._settings.tesseract_configuration.generate_shell_configuration(), self._settings.tesseract_configuration.recognition_language)
+
+        result=self._ocr_cache.get(key)
+        if result!=None:
+            future=Future()
+            future.set_result(result)
+
+            return future
+
+        return self._executor.submit(self._segment_to_cache, key, image)
+    def _segment_to_cache(self, key, image):
+        result=boxes_to_list(segment_image(image, self._settings.tesseract_configuration))
+        self._ocr_cache.put(key, result)
+
+        return result
+
+    def status(self):
+        return {
+            "workers": self._settings.daemon_configuration.workers,
+            "ocr cache": {"size": len(self._ocr_cache), "hits": self._ocr_cache.hits, "misses": self._ocr_cache.misses},
+            "mathpix cache": {"size": len(self._mathpix_cache), "hits": self._mathpix_cache.hits, "misses": self._mathpix_cache.misses},
+            "recognition": self._recognizer.statistics(),
+            }
+    def is_authorized(self, authorization):
+        token=self._settings.daemon_configuration.token
+        if token==None:
+            return True
+
+        return hmac.compare_digest((authorization or "").encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads=True
+
+    def server_bind(self):
+
+        # A socket left by a daemon which didn't exit cleanly is replaced, a running daemon is kept
+
+        if path.exists(self.server_address):
+            probe=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.server_address)
+                raise OSError(f"A daemon is already listening on {self.server_address}.")
+            except ConnectionRefusedError:
+                os.remove(self.server_address)
+            finally:
+                probe.close()
+
+        os.makedirs(path.dirname(self.server_address), exist_ok=True)
+
+        # The socket is created with its final permissions, so there's no moment others could connect
+
+        umask=os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+
+    MAXIMUM_BODY_SIZE=256*1024*1024 # Bytes, well above an uncompressed page scanned at 600 dpi
+
+    def do_GET(self):
+        if not self._authorize():
+            return
+
+        if urlparse(self.path).path=="/status":
+            self._send_json(self.server.daemon.status())
+        else:
+            self.send_error(404)
+    def do_POST(self):
+
+        # The body is read only from authorized clients and up to a limit
+
+        if not self._authorize():
+            return
+
+        try:
+            length=int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return
+        if length<0 or length>DaemonRequestHandler.MAXIMUM_BODY_SIZE:
+            self.close_connection=True
+            self.send_error(413)
+            return
+
+        url=urlparse(self.path)
+        query=parse_qs(url.query)
+        body=self.rfile.read(length)
+        daemon=self.server.daemon
+
+        try:
+            if url.path=="/segment":
+                self._send_json(daemon.segment(Image.open(BytesIO(body))))
+            elif url.path=="/split":
+                splits=[int(i) for i in query.get("splits", [""])[0].split(",") if i!=""]
+                self._send_json(daemon.split(Image.open(BytesIO(body)), splits))
+            elif url.path=="/recognize":
+                self._send_body(daemon.recognize(Image.open(BytesIO(body))).encode("utf-8"), "application/json")
+            else:
+                self.send_error(404)
+        except (FileNotFoundError, KeyError, ValueError, OSError) as e:
+            self.send_error(400, str(e))
+        except Exception as e:
+
+            # Failures of Tesseract or Mathpix are reported to the client instead of dropping the connection
+
+            self.send_error(500, f"{type(e).__name__}: {e}")
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix socket"
+
+    def _authorize(self):
+        if self.server.daemon.is_authorized(self.headers.get("Authorization")):
+            return True
+
+        self.send_error(401)
+
+        return False
+    def _send_json(self, value):
+        self._send_body(json.dumps(value).encode("utf-8"), "application/json")
+    def _send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+class DaemonError(Exception):
+    pass
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+
+        self._socket_path=socket_path
+
+    def connect(self):
+        self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+class DaemonClient:
+
+    # Mirrors segment_image and MathpixRecognizer.recognize, delegating the work to a running daemon. Failures of the daemon or the connection raise DaemonError
+
+    def __init__(self, configuration):
+        self._configuration=configuration
+
+    def segment_image(self, image, tesseract_configuration=None):
+        return boxes_from_list(json.loads(self._request("POST", "/segment", encode_png(image), timeout=300)))
+    def split(self, image, splits):
+        query=urlencode({"splits": ",".join([str(i) for i in splits])})
+
+        return [boxes_from_list(i) for i in json.loads(self._request("POST", f"/split?{query}", encode_png(image), timeout=300))]
+    def recognize(self, image):
+        return self._request("POST", "/recognize", encode_png(image), timeout=60).decode("utf-8")
+    def status(self):
+        return json.loads(self._request("GET", "/status", timeout=5))
+
+    def _request(self, method, url, body=None, timeout=60):
+        configuration=self._configuration
+
+        if configuration.socket_path!=None:
+            connection=UnixHTTPConnection(configuration.socket_path, timeout)
+        else:
+            connection=http.client.HTTPConnection(configuration.host, configuration.port, timeout=timeout)
+
+        headers={"Content-Type": "image/png"} if body!=None else {}
+        if configuration.token!=None:
+            headers["Authorization"]=f"Bearer {configuration.token}"
+
+        try:
+            connection.request(method, url, body=body, headers=headers)
+            response=connection.getresponse()
+            data=response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise DaemonError(f"The daemon can't be reached. {e}")
+        finally:
+            connection.close()
+
+        if response.status!=200:
+            raise DaemonError(f"The daemon failed with {response.status} {response.reason}.")
+
+        return data
+
+class PageStore:
+
+    # Keeps the character boxes of processed image files on disk. Entries are identified by the file, its modification time and size, and the settings affecting the recognition, so changing any of them makes the old entry unreachable
+
+    @property
+    def directory(self): return self._directory
+
+    def __init__(self, directory=None, capacity=2000):
+        self._directory=directory if directory!=None else path.join(appdirs.user_cache_dir("math_scanner"), "pages")
+        self._capacity=capacity
+
+        self._lock=threading.Lock()
+        self._entry_count=None # Counted on the first write, other processes writing to the cache are noticed on the next eviction
+
+        os.makedirs(self._directory, exist_ok=True)
+
+    def key(file_path, settings):
+
+        # Batch results are identified by the same keys
+
+        stat=os.stat(file_path)
+        signature=json.dumps([path.abspath(file_path), stat.st_mtime_ns, stat.st_size, PageStore.settings_signature(settings)])
+
+        return hashlib.sha1(signature.encode("utf-8")).hexdigest()
+    def settings_signature(settings):
+
+        # Identifies the settings influencing the character boxes of a page. Pages recognized with equal signatures are interchangeable
+
+        signature=json.dumps([
+            vars(settings.input_image_processing_configuration),
+            vars(settings.tesseract_configuration),
+            ], sort_keys=True)
+
+        return hashlib.sha1(signature.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        file_path=path.join(self._directory, f"{key}.json")
+
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                boxes=boxes_from_list(json.load(f)["boxes"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        # The modification time marks the recently used entries, which are evicted last
+
+        try:
+            os.utime(file_path)
+        except OSError:
+            pass
+
+        return boxes
+    def put(self, key, boxes):
+
+        # The entry is written to a temporary file first, so a reader never sees it incomplete
+
+        file_path=path.join(self._directory, f"{key}.json")
+        temporary_path=f"{file_path}.{threading.get_ident()}.tmp"
+        new=not path.exists(file_path)
+
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"boxes": boxes_to_list(boxes)}, f)
+
+        os.replace(temporary_path, file_path)
+
+        if new:
+            self._count_entry()
+
+    def _count_entry(self):
+        with self._lock:
+            if self._entry_count==None:
+                self._entry_count=len([entry for entry in os.scandir(self._directory) if entry.name.endswith(".json")])
+            else:
+                self._entry_count+=1
+
+            if self._entry_count>self._capacity:
+                self._evict()
+    def _evict(self):
+
+        # The least recently used entries are deleted down to nine tenths of the capacity, so the directory isn't scanned on every write of a full cache
+
+        entries=sorted([entry for entry in os.scandir(self._directory) if entry.name.endswith(".json")], key=lambda entry: entry.stat().st_mtime)
+        excess=len(entries)-self._capacity*9//10
+
+        for entry in entries[:max(excess, 0)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+        self._entry_count=min(len(entries), self._capacity*9//10)
+
+class PageIndex:
+
+    # Finds pages looking nearly the same as an already recognized one, such as repeated scans or screenshots of the same page, using perceptual hashes. Thumbnails of both images rule out clearly different pages, a found page is then verified and aligned to whole pixels by comparing larger samples, kept on disk next to the index
+
+    THUMBNAIL_SIZE=128
+    SAMPLE_SIZE=1024
+    MAXIMUM_DISTANCE=18 # Of 64 bits. Hashes of text pages are quite noisy, the hash only preselects candidates for the comparison of thumbnails
+    MINIMUM_THUMBNAIL_CORRELATION=0.6 # Thumbnails blur the text away, so pages with the same layout look alike in them and only the samples can tell them apart
+    MINIMUM_CORRELATION=0.7
+    CAPACITY=2000
+    RECORD_DTYPE=np.dtype([("hash", "<u8"), ("size", "<i4", (2, )), ("signature", "S40"), ("key", "S40"), ("thumbnail", "u1", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))])
+
+    def __init__(self, directory):
+        self._directory=directory
+        self._file_path=path.join(directory, "index.bin")
+        self._lock_path=path.join(directory, "index.lock")
+        self._lock=threading.Lock()
+
+        # The index file is shared by all processes using the cache, like Math scanner and the folder watcher. Entries are appended to it and each process reads just the ones appended since its last look, so it can be unloaded any time and loaded again when needed
+
+        self._loaded=False
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+
+            return len(self._records)
+
+    def memory_usage(self):
+        with self._lock:
+            if not self._loaded:
+                return 0
+
+            return self._records.nbytes
+    def unload(self):
+        with self._lock:
+            self._loaded=False
+            self._records=None
+
+    def perceptual_hash(image):
+
+        # Difference hash, each bit tells whether a pixel of a 9x8 thumbnail is brighter than its right neighbour
+
+        pixels=np.asarray(ImageOps.grayscale(image).resize((9, 8), Image.BOX), dtype=np.int16)
+        bits=(pixels[:, 1:]>pixels[:, :-1]).flatten()
+
+        return np.uint64(int("".join(["1" if b else "0" for b in bits]), 2))
+    def thumbnail(image):
+        return np.asarray(ImageOps.grayscale(image).resize((PageIndex.THUMBNAIL_SIZE, PageIndex.THUMBNAIL_SIZE), Image.BOX), dtype=np.uint8)
+    def sample(image, scale=None):
+        scale=scale if scale!=None else min(PageIndex.SAMPLE_SIZE/max(image.size), 1)
+
+        return ImageOps.grayscale(image).resize((max(round(image.size[0]*scale), 1), max(round(image.size[1]*scale), 1)), Image.BOX)
+    def boxes_fit(image, boxes):
+
+        # Moved boxes are only trusted when they stay inside the image and nearly all characters still cover both ink and background
+
+        characters=[ch for line in boxes for ch in line if ch.character.strip()!=""]
+        if len(characters)==0:
+            return True
+
+        width, height=image.size
+        if min([ch.bottom_left_x for ch in characters])<0 or max([ch.top_right_x for ch in characters])>width or min([ch.bottom_left_y for ch in characters])<0 or max([ch.top_right_y for ch in characters])>height:
+            return False
+
+        pixels=np.asarray(ImageOps.grayscale(image))
+        threshold=ImageProcessor.otsu_threshold(image)
+        characters=characters[::max(len(characters)//500, 1)]
+        covered=0
+
+        for ch in characters:
+            box=pixels[height-ch.top_right_y:height-ch.bottom_left_y, ch.bottom_left_x:ch.top_right_x]
+
+            if box.size>0 and box.min()<threshold<=box.max():
+                covered+=1
+
+        return covered>=0.9*len(characters)
+
+    def add(self, image, signature, key, image_hash=None, thumbnail=None):
+        image_hash=image_hash if image_hash!=None else PageIndex.perceptual_hash(image)
+        thumbnail=thumbnail if thumbnail is not None else PageIndex.thumbnail(image)
+
+        sample_path=self._sample_path(key)
+        temporary_path=f"{sample_path}.{threading.get_ident()}.tmp.png"
+        PageIndex.sample(image).save(temporary_path)
+        os.replace(temporary_path, sample_path)
+
+        record=np.zeros(1, dtype=PageIndex.RECORD_DTYPE)
+        record["hash"], record["size"], record["signature"], record["key"], record["thumbnail"]=image_hash, image.size, signature.encode("ascii"), key.encode("ascii"), thumbnail
+
+        with self._lock:
+            lock=self._lock_file()
+            try:
+
+                # A single appending write, so records of other processes are never overwritten
+
+                descriptor=os.open(self._file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o600)
+                try:
+                    os.write(descriptor, record.tobytes())
+                finally:
+                    os.close(descriptor)
+
+                if os.path.getsize(self._file_path)>2*PageIndex.CAPACITY*PageIndex.RECORD_DTYPE.itemsize:
+                    self._compact()
+                else:
+                    self._refresh()
+            finally:
+                self._unlock_file(lock)
+    def find(self, image, signature, image_hash=None, thumbnail=None):
+
+        # Returns the key of a matching page and the offset of the image against it in pixels, or None
+
+        image_hash=image_hash if image_hash!=None else PageIndex.perceptual_hash(image)
+        thumbnail=thumbnail if thumbnail is not None else PageIndex.thumbnail(image)
+
+        with self._lock:
+            self._refresh()
+
+            if len(self._records)==0:
+                return None
+
+            records=self._records
+            distances=np.unpackbits((records["hash"]^image_hash).view(np.uint8)).reshape(-1, 64).sum(axis=1)
+            size_differences=np.abs(records["size"]-np.array(image.size)).max(axis=1)/max(image.size)
+            signatures=records["signature"]==signature.encode("ascii")
+
+            candidates=np.flatnonzero((distances<=PageIndex.MAXIMUM_DISTANCE) & (size_differences<=0.05) & signatures)
+            candidates=candidates[np.argsort(distances[candidates])]
+
+            candidates=[(records["key"][i].decode("ascii"), records["size"][i]) for i in candidates[:5] if PageIndex._align(records["thumbnail"][i], thumbnail)[2]>=PageIndex.MINIMUM_THUMBNAIL_CORRELATION]
+
+        for key, size in candidates:
+            try:
+                with Image.open(self._sample_path(key)) as reference:
+                    reference=np.asarray(reference.convert("L"))
+            except (FileNotFoundError, OSError):
+                continue
+
+            # The image is sampled at the scale of the reference sample, so whole pixels of both match
+
+            scale=reference.shape[1]/size[0]
+            dx, dy, correlation=PageIndex._match(reference, np.asarray(PageIndex.sample(image, scale)))
+
+            if correlation>=PageIndex.MINIMUM_CORRELATION:
+                return key, round(dx/scale), round(dy/scale)
+
+        return None
+
+    def _sample_path(self, key):
+        return path.join(self._directory, f"{key}.sample.png")
+    def _match(reference, sample):
+
+        # Phase correlation of the samples gives their offset in whole pixels, the correlation of the overlapping parts then confirms they show the same page
+
+        height=min(reference.shape[0], sample.shape[0])
+        width=min(reference.shape[1], sample.shape[1])
+        a=reference[:height, :width].astype(np.float32)
+        b=sample[:height, :width].astype(np.float32)
+        a-=a.mean()
+        b-=b.mean()
+
+        cross_power=np.fft.rfft2(b)*np.conj(np.fft.rfft2(a))
+        surface=np.fft.irfft2(cross_power/(np.abs(cross_power)+1e-9), s=(height, width))
+
+        peak_y, peak_x=np.unravel_index(np.argmax(surface), surface.shape)
+        dx=int(peak_x-width if peak_x>width//2 else peak_x)
+        dy=int(peak_y-height if peak_y>height//2 else peak_y)
+
+        if abs(dx)>=width/8 or abs(dy)>=height/8:
+            return dx, dy, 0.0
+
+        a=a[max(-dy, 0):height-max(dy, 0), max(-dx, 0):width-max(dx, 0)]
+        b=b[max(dy, 0):height-max(-dy, 0), max(dx, 0):width-max(-dx, 0)]
+        a=a-a.mean()
+        b=b-b.mean()
+        norm=np.sqrt(float((a**2).sum())*float((b**2).sum()))
+        correlation=float((a*b).sum()/norm) if norm>0 else 0.0
+
+        # The returned offset is refined below a pixel of the sample by fitting a parabola to the peak, as one pixel of the sample spans several of the image
+
+        def refine(minus, center, plus):
+            denominator=minus-2*center+plus
+            return 0.5*(minus-plus)/denominator if denominator!=0 else 0.0
+
+        dx+=float(refine(surface[peak_y, peak_x-1], surface[peak_y, peak_x], surface[peak_y, (peak_x+1)%width]))
+        dy+=float(refine(surface[peak_y-1, peak_x], surface[peak_y, peak_x], surface[(peak_y+1)%height, peak_x]))
+
+        return dx, dy, correlation
+    def _align(reference, thumbnail):
+
+        # Phase correlation gives the shift of the thumbnail against the reference, refined to subpixel precision by fitting a parabola to the peak. The correlation of the aligned thumbnails then tells how alike the pages look at a glance
+
+        a=reference.astype(np.float64)-reference.mean()
+        b=thumbnail.astype(np.float64)-thumbnail.mean()
+
+        cross_power=np.fft.fft2(b)*np.conj(np.fft.fft2(a))
+        surface=np.fft.ifft2(cross_power/(np.abs(cross_power)+1e-9)).real
+
+        size=surface.shape[0]
+        peak_y, peak_x=np.unravel_index(np.argmax(surface), surface.shape)
+
+        def refine(minus, center, plus):
+            denominator=minus-2*center+plus
+            return 0.5*(minus-plus)/denominator if denominator!=0 else 0.0
+
+        dx=peak_x+refine(surface[peak_y, peak_x-1], surface[peak_y, peak_x], surface[peak_y, (peak_x+1)%size])
+        dy=peak_y+refine(surface[peak_y-1, peak_x], surface[peak_y, peak_x], surface[(peak_y+1)%size, peak_x])
+        if dx>size/2: dx-=size
+        if dy>size/2: dy-=size
+
+        if abs(dx)>=size/4 or abs(dy)>=size/4:
+            return dx, dy, 0.0
+
+        # The thumbnail is moved back by the subpixel offset in the frequency domain, the edges, where the images don't overlap, are left out of the comparison
+
+        frequencies=np.fft.fftfreq(size)
+        aligned=np.fft.ifft2(np.fft.fft2(b)*np.exp(2j*np.pi*(frequencies[np.newaxis, :]*dx+frequencies[:, np.newaxis]*dy))).real
+
+        margin=int(np.ceil(max(abs(dx), abs(dy))))+2
+        a=a[margin:size-margin, margin:size-margin]
+        aligned=aligned[margin:size-margin, margin:size-margin]
+        a=a-a.mean()
+        aligned=aligned-aligned.mean()
+        norm=np.sqrt((a**2).sum()*(aligned**2).sum())
+
+        return dx, dy, float((a*aligned).sum()/norm) if norm>0 else 0.0
+    def _refresh(self):
+
+        # Reads the records appended since the last look. A compaction by any process replaces the file, which is then read again whole
+
+        try:
+            stat=os.stat(self._file_path)
+        except FileNotFoundError:
+            stat=None
+
+        if not self._loaded or stat==None or stat.st_ino!=self._inode or stat.st_size<self._offset:
+            self._records=np.zeros(0, dtype=PageIndex.RECORD_DTYPE)
+            self._offset=0
+            self._inode=stat.st_ino if stat!=None else None
+            self._loaded=True
+
+        if stat==None or stat.st_size-self._offset<PageIndex.RECORD_DTYPE.itemsize:
+            return
+
+        with open(self._file_path, "rb") as f:
+            f.seek(self._offset)
+            data=f.read((stat.st_size-self._offset)//PageIndex.RECORD_DTYPE.itemsize*PageIndex.RECORD_DTYPE.itemsize)
+
+        self._records=np.concatenate((self._records, np.frombuffer(data, dtype=PageIndex.RECORD_DTYPE)))[-PageIndex.CAPACITY:]
+        self._offset+=len(data)
+    def _compact(self):
+
+        # Keeps just the newest records, called with the file locked. Samples of the pages falling out of the index are deleted with them
+
+        self._loaded=False
+        self._refresh()
+
+        temporary_path=f"{self._file_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(self._records.tobytes())
+        os.replace(temporary_path, self._file_path)
+
+        # Recent samples may belong to records other processes are just appending
+
+        kept=set([f"{key.decode('ascii')}.sample.png" for key in self._records["key"]])
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith(".sample.png") and entry.name not in kept and entry.stat().st_mtime<time.time()-60:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+        self._loaded=False
+        self._refresh()
+    def _lock_file(self):
+
+        # Serializes changes of the index among processes. Windows has no advisory locks, the appending writes alone keep the records intact there
+
+        if platform.system()=="Windows":
+            return None
+
+        lock=open(self._lock_path, "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        return lock
+    def _unlock_file(self, lock):
+        if lock!=None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+def shift_boxes(boxes, dx, dy):
+
+    # The offset is given in image coordinates, while the boxes use Tesseract's, with the y axis pointing up
+
+    return [[CharacterBox(ch.character, ch.bottom_left_x+dx, ch.bottom_left_y-dy, ch.top_right_x+dx, ch.top_right_y-dy) for ch in line] for line in boxes]
+
+class FolderWatcher:
+
+    # Recognizes image files as they appear in a folder, so they can be later opened without waiting. Linux uses inotify, other systems are polled
+
+    IMAGE_EXTENSIONS=(".bmp", ".gif", ".jpeg", ".jpg", ".pbm", ".pgm", ".png", ".ppm", ".tif", ".tiff", ".webp")
+
+    IN_MODIFY=0x2
+    IN_CLOSE_WRITE=0x8
+    IN_MOVED_TO=0x80
+    IN_CREATE=0x100
+
+    @property
+    def queue_depth(self):
+        with self._lock:
+            return len(self._pending)+self._running
+
+    @property
+    def lag(self):
+
+        # How long the oldest file waiting for recognition has been waiting
+
+        with self._lock:
+            times=list(self._pending.values())+list(self._running_since.values())
+
+        return time.time()-min(times) if len(times)>0 else 0.0
+
+    @property
+    def processed_count(self): return self._processed_count
+
+    def __init__(self, folder, settings, page_store, page_index=None, debounce=1.0, workers=2, on_processed=None):
+
+        self._folder=folder
+        self._settings=settings
+        self._page_store=page_store
+        self._page_index=page_index
+        self._debounce=debounce
+        self._on_processed=on_processed
+
+        self._executor=ThreadPoolExecutor(max_workers=workers)
+        self._lock=threading.Lock()
+        self._pending={} # Path: time of the first unprocessed change
+        self._last_change={} # Path: time of the last change, used for debouncing
+        self._running=0
+        self._running_since={}
+        self._processed_count=0
+        self._stopped=False
+
+    def run(self):
+
+        # Files present before the start are processed as well, those already in the page store are skipped quickly
+
+        for entry in os.scandir(self._folder):
+            self._file_changed(entry.path)
+
+        if platform.system()=="Linux":
+            self._run_inotify()
+        else:
+            self._run_polling()
+
+        self._executor.shutdown()
+    def stop(self):
+        self._stopped=True
+
+    def _run_inotify(self):
+        libc=ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        fd=libc.inotify_init()
+        if fd<0:
+            return self._run_polling()
+
+        libc.inotify_add_watch(fd, self._folder.encode(), FolderWatcher.IN_MODIFY | FolderWatcher.IN_CLOSE_WRITE | FolderWatcher.IN_MOVED_TO | FolderWatcher.IN_CREATE)
+
+        try:
+            while not self._stopped:
+                readable, _, _=select.select([fd], [], [], self._debounce/4)
+
+                if fd in readable:
+                    data=os.read(fd, 65536)
+
+                    # The buffer contains inotify_event structures, each with a variable length name
+
+                    offset=0
+                    while offset<len(data):
+                        _, mask, _, name_length=struct.unpack_from("iIII", data, offset)
+                        name=data[offset+16:offset+16+name_length].rstrip(b"\0").decode("utf-8", "replace")
+                        offset+=16+name_length
+
+                        self._file_changed(path.join(self._folder, name), finished=(mask & (FolderWatcher.IN_CLOSE_WRITE | FolderWatcher.IN_MOVED_TO))!=0)
+
+                self._submit_settled_files()
+        finally:
+            os.close(fd)
+    def _run_polling(self):
+        states={}
+
+        while not self._stopped:
+            for entry in os.scandir(self._folder):
+                try:
+                    stat=entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                state=(stat.st_mtime_ns, stat.st_size)
+                if states.get(entry.path)!=state:
+                    states[entry.path]=state
+                    self._file_changed(entry.path)
+
+            self._submit_settled_files()
+            time.sleep(self._debounce/4)
+
+    def _file_changed(self, file_path, finished=False):
+        if not file_path.lower().endswith(FolderWatcher.IMAGE_EXTENSIONS):
+            return
+
+        now=time.time()
+
+        with self._lock:
+            self._pending.setdefault(file_path, now)
+
+            # A closed or moved in file is complete, otherwise we wait until the writes stop
+
+            self._last_change[file_path]=now-self._debounce if finished else now
+    def _submit_settled_files(self):
+        now=time.time()
+
+        with self._lock:
+            # A file changed while being processed waits for the running job to finish
+
+            settled=[p for p, t in self._last_change.items() if now-t>=self._debounce and p not in self._running_since]
+
+            for p in settled:
+                del self._last_change[p]
+                self._running_since[p]=self._pending.pop(p)
+                self._running+=1
+
+        for p in settled:
+            self._executor.submit(self._process, p)
+    def _process(self, file_path):
+        try:
+            key=PageStore.key(file_path, self._settings)
+
+            if self._page_store.get(key)==None:
+                configuration=self._settings.input_image_processing_configuration
+                image=ImageProcessor.process_image(ImageProcessor.open_image(file_path, configuration), configuration)
+
+                self._page_store.put(key, segment_image(image, self._settings.tesseract_configuration))
+                if self._page_index!=None:
+                    self._page_index.add(image, PageStore.settings_signature(self._settings), key)
+        except (OSError, ValueError, pytesseract.TesseractError, Image.DecompressionBombError) as e:
+
+            # A failed file is still reported as processed, so the progress stays complete
+
+            print(f"{file_path}: {e}", file=sys.stderr)
+        finally:
+            with self._lock:
+                started=self._running_since.pop(file_path)
+                self._running-=1
+                self._processed_count+=1
+
+        if self._on_processed!=None:
+            self._on_processed(file_path, time.time()-started)
+
+class Project:
+
+    # A file holding processed pages, so that a document can be reopened without any recognition.
+    #
+    # The file starts with a header pointing to a page table at its end. Each page table entry locates the page's metadata, a small json document with the image path, borders, columns and Mathpix results. Character boxes of the page and its columns are stored as packed arrays of fixed-width records referenced from the metadata. The file is memory mapped and only the pages actually viewed are ever read.
+
+    MAGIC=b"MSPR"
+    VERSION=1
+    HEADER_FORMAT="<4sHHIQ" # Magic, version, reserved, page count, page table offset
+    PAGE_TABLE_ENTRY_FORMAT="<QQ" # Metadata offset and length
+    BOX_DTYPE=np.dtype([("character", "<u4"), ("bottom_left_x", "<i4"), ("bottom_left_y", "<i4"), ("top_right_x", "<i4"), ("top_right_y", "<i4")])
+    EXTRA_CHARACTER_BASE=0x110000 # Characters above the unicode range refer to the list of multi-character strings in the metadata
+
+    @property
+    def page_count(self): return self._page_count
+
+    def __init__(self, file_path):
+
+        self._file=open(file_path, "rb")
+        self._map=mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self._page_count, self._page_table_offset=struct.unpack_from(Project.HEADER_FORMAT, self._map, 0)
+        if magic!=Project.MAGIC or version!=Project.VERSION:
+            self.close()
+            raise ValueError(f"{file_path} is not a Math scanner project.")
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def page(self, index):
+
+        # Returns the page as a dictionary, with the boxes of its views decoded
+
+        entry_offset=self._page_table_offset+index*struct.calcsize(Project.PAGE_TABLE_ENTRY_FORMAT)
+        metadata_offset, metadata_length=struct.unpack_from(Project.PAGE_TABLE_ENTRY_FORMAT, self._map, entry_offset)
+
+        page=json.loads(self._map[metadata_offset:metadata_offset+metadata_length].decode("utf-8"))
+
+        for view in page["views"]:
+            records=np.frombuffer(self._map, dtype=Project.BOX_DTYPE, count=view["box count"], offset=view["box offset"]) if view["box count"]>0 else np.zeros(0, dtype=Project.BOX_DTYPE)
+            line_lengths=np.frombuffer(self._map, dtype="<u4", count=view["line count"], offset=view["line offset"]) if view["line count"]>0 else []
+
+            view["boxes"]=Project._decode_boxes(records, line_lengths, page["extra characters"])
+
+        return page
+
+    def write(file_path, pages):
+
+        # Pages are dictionaries in the format returned by page. The file is written next to the target and moved over it at the end
+
+        temporary_path=f"{file_path}.tmp"
+        page_table=[]
+
+        with open(temporary_path, "wb") as f:
+            f.write(b"\0"*struct.calcsize(Project.HEADER_FORMAT))
+
+            for page in pages:
+                page=dict(page)
+                extra_characters=[]
+                views=[]
+
+                for view in page["views"]:
+                    records, line_lengths=Project._encode_boxes(view["boxes"], extra_characters)
+
+                    view={key: value for key, value in view.items() if key!="boxes"}
+                    view["box offset"], view["box count"]=Project._write_array(f, records), len(records)
+                    view["line offset"], view["line count"]=Project._write_array(f, line_lengths), len(line_lengths)
+                    views.append(view)
+
+                page["views"]=views
+                page["extra characters"]=extra_characters
+
+                metadata=json.dumps(page).encode("utf-8")
+                page_table.append((f.tell(), len(metadata)))
+                f.write(metadata)
+
+            page_table_offset=Project._align(f)
+            for entry in page_table:
+                f.write(struct.pack(Project.PAGE_TABLE_ENTRY_FORMAT, *entry))
+
+            f.seek(0)
+            f.write(struct.pack(Project.HEADER_FORMAT, Project.MAGIC, Project.VERSION, 0, len(page_table), page_table_offset))
+
+        os.replace(temporary_path, file_path)
+
+    def _encode_boxes(boxes, extra_characters):
+        records=np.zeros(sum([len(line) for line in boxes]), dtype=Project.BOX_DTYPE)
+        line_lengths=np.array([len(line) for line in boxes], dtype="<u4")
+
+        i=0
+        for line in boxes:
+            for ch in line:
+                if len(ch.character)==1:
+                    character=ord(ch.character)
+                else:
+                    character=Project.EXTRA_CHARACTER_BASE+len(extra_characters)
+                    extra_characters.append(ch.character)
+
+                records[i]=(character, ch.bottom_left_x, ch.bottom_left_y, ch.top_right_x, ch.top_right_y)
+                i+=1
+
+        return records, line_lengths
+    def _decode_boxes(records, line_lengths, extra_characters):
+        boxes=[]
+
+        i=0
+        for line_length in line_lengths:
+            line=[]
+            for character, bottom_left_x, bottom_left_y, top_right_x, top_right_y in records[i:i+line_length].tolist():
+                character=chr(character) if character<Project.EXTRA_CHARACTER_BASE else extra_characters[character-Project.EXTRA_CHARACTER_BASE]
+                line.append(CharacterBox(character, bottom_left_x, bottom_left_y, top_right_x, top_right_y))
+            boxes.append(line)
+            i+=line_length
+
+        return boxes
+    def _write_array(f, array):
+        offset=Project._align(f)
+        f.write(np.ascontiguousarray(array).tobytes())
+
+        return offset
+    def _align(f):
+
+        # Arrays start on 8 byte boundaries, so they can be mapped directly
+
+        padding=-f.tell()%8
+        f.write(b"\0"*padding)
+
+        return f.tell()
+
+def split_to_words(line):
+    words=[[]]
+    for ch in line:
+        if ch.character==" ":
+            words.append([])
+        else:
+            words[-1].append(ch)
+
+    return [word for word in words if len(word)>0]
+def top_down_box(boxes, height):
+
+    # Tesseract measures y from the bottom of the image, hOCR and ALTO from the top. Returns left, top, right and bottom of the boxes
+
+    return (min([ch.bottom_left_x for ch in boxes]), height-max([ch.top_right_y for ch in boxes]), max([ch.top_right_x for ch in boxes]), height-min([ch.bottom_left_y for ch in boxes]))
+def boxes_to_hocr(boxes, size, title):
+    width, height=size
+    lines=[]
+
+    for i, line in enumerate(boxes):
+        words=split_to_words(line)
+        if len(words)==0:
+            continue
+
+        line_box=" ".join([str(v) for v in top_down_box(line, height)])
+        words=" ".join([f"<span class='ocrx_word' title='bbox {' '.join([str(v) for v in top_down_box(word, height)])}'>{escape(''.join([ch.character for ch in word]))}</span>" for word in words])
+        lines.append(f"   <span class='ocr_line' id='line_{i+1}' title='bbox {line_box}'>{words}</span>")
+
+    lines="\n".join(lines)
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title>{escape(title)}</title>
+  <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+  <meta name="ocr-system" content="math_scanner" />
+  <meta name="ocr-capabilities" content="ocr_page ocr_line ocrx_word" />
+ </head>
+ <body>
+  <div class='ocr_page' id='page_1' title={quoteattr(f"image {title}; bbox 0 0 {width} {height}")}>
+{lines}
+  </div>
+ </body>
+</html>
+"""
+def boxes_to_alto(boxes, size, file_name):
+    width, height=size
+    lines=[]
+
+    for i, line in enumerate(boxes):
+        words=split_to_words(line)
+        if len(words)==0:
+            continue
+
+        strings=[]
+        for word in words:
+            left, top, right, bottom=top_down_box(word, height)
+            strings.append(f"<String HPOS=\"{left}\" VPOS=\"{top}\" WIDTH=\"{right-left}\" HEIGHT=\"{bottom-top}\" CONTENT={quoteattr(''.join([ch.character for ch in word]))}/>")
+
+        left, top, right, bottom=top_down_box(line, height)
+        lines.append(f"      <TextLine ID=\"line_{i+1}\" HPOS=\"{left}\" VPOS=\"{top}\" WIDTH=\"{right-left}\" HEIGHT=\"{bottom-top}\">{'<SP/>'.join(strings)}</TextLine>")
+
+    lines="\n".join(lines)
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#">
+  <Description>
+    <MeasurementUnit>pixel</MeasurementUnit>
+    <sourceImageInformation><fileName>{escape(file_name)}</fileName></sourceImageInformation>
+  </Description>
+  <Layout>
+    <Page ID="page_1" PHYSICAL_IMG_NR="1" WIDTH="{width}" HEIGHT="{height}">
+     <PrintSpace HPOS="0" VPOS="0" WIDTH="{width}" HEIGHT="{height}">
+      <TextBlock ID="block_1">
+{lines}
+      </TextBlock>
+     </PrintSpace>
+    </Page>
+  </Layout>
+</alto>
+"""
+
+class ResultSink:
+
+    # Streams results of a batch run to a directory. Pages are buffered only up to the chunk size, then committed together: their hOCR and ALTO documents, a chunk of JSON lines with one page result per line, and finally the manifest listing the committed chunks and pages. Every file is written to a temporary file and renamed, so a run killed at any moment leaves just complete files, and the manifest never refers to anything missing. A restarted run skips the pages found in the manifest
+
+    MANIFEST_FILE="manifest.json"
+
+    @property
+    def directory(self): return self._directory
+
+    @property
+    def completed_count(self): return len(self._manifest["pages"])
+
+    def __init__(self, directory, chunk_size=16):
+
+        self._directory=directory
+        self._chunk_size=chunk_size
+        self._buffer=[] # Pairs of page keys and results waiting for the commit
+
+        os.makedirs(path.join(directory, "pages"), exist_ok=True)
+
+        # Temporary files are leftovers of an interrupted commit
+
+        for directory_path in (directory, path.join(directory, "pages")):
+            for entry in os.scandir(directory_path):
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)
+
+        try:
+            with open(path.join(directory, ResultSink.MANIFEST_FILE), "r", encoding="utf-8") as f:
+                self._manifest=json.load(f)
+        except FileNotFoundError:
+            self._manifest={"chunks": [], "pages": {}}
+
+    def is_completed(self, key):
+        return key in self._manifest["pages"] or key in [k for k, _ in self._buffer]
+
+    def add(self, key, result):
+        self._buffer.append((key, result))
+
+        if len(self._buffer)>=self._chunk_size:
+            self.flush()
+    def flush(self):
+        if len(self._buffer)==0:
+            return
+
+        chunk=f"chunk-{len(self._manifest['chunks'])+1:05d}.jsonl"
+        pages={}
+
+        for line, (key, result) in enumerate(self._buffer):
+            name=f"{path.splitext(path.basename(result['path']))[0]}-{key[:8]}"
+            boxes=boxes_from_list(result["views"][0]["boxes"])
+
+            self._write(path.join("pages", f"{name}.hocr"), boxes_to_hocr(boxes, result["size"], path.basename(result["path"])))
+            self._write(path.join("pages", f"{name}.xml"), boxes_to_alto(boxes, result["size"], path.basename(result["path"])))
+
+            pages[key]={"path": result["path"], "chunk": chunk, "line": line, "hocr": f"pages/{name}.hocr", "alto": f"pages/{name}.xml"}
+
+        self._write(chunk, "".join([json.dumps(dict(result, key=key), ensure_ascii=False)+"\n" for key, result in self._buffer]))
+
+        # The commit becomes visible only with the manifest
+
+        manifest={"chunks": self._manifest["chunks"]+[chunk], "pages": dict(self._manifest["pages"], **pages)}
+        self._write(ResultSink.MANIFEST_FILE, json.dumps(manifest, indent=1))
+
+        self._manifest=manifest
+        self._buffer=[]
+    def close(self):
+        self.flush()
+
+    def _write(self, name, content):
+        file_path=path.join(self._directory, name)
+        temporary_path=f"{file_path}.tmp"
+
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temporary_path, file_path)
+
+class Profiler:
+
+    # Collects evidence of slow operations. The thread running a profiled operation is traced by cProfile, while stacks of all threads are sampled in regular intervals, showing the time spent in worker threads too. Sampling pauses between operations, so an idle application isn't slowed down
+
+    PUBLIC_STRING_SETTINGS=("recognition_language", "local_language", "blackwhite_method", "host")
+
+    @property
+    def directory(self): return self._directory
+
+    def __init__(self, directory, interval=0.005):
+
+        self._directory=directory
+        self._interval=interval
+
+        self._profile=cProfile.Profile()
+        self._lock=threading.Lock()
+        self._profiling=False # Whether cProfile is tracing an operation, it can trace just one thread at a time
+        self._running=0 # The number of operations in progress
+        self._stacks={} # Collapsed stacks: sample counts
+        self._operations=[] # Names, durations and image sizes of the finished operations
+
+        self._stopped=threading.Event()
+        self._sampler=threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def run(self, name, image_size, function, *args):
+        with self._lock:
+            self._running+=1
+            trace=not self._profiling
+            self._profiling=True
+
+        start=time.perf_counter()
+        if trace:
+            self._profile.enable()
+
+        try:
+            return function(*args)
+        finally:
+            if trace:
+                self._profile.disable()
+            duration=time.perf_counter()-start
+
+            with self._lock:
+                self._running-=1
+                self._profiling=self._profiling and not trace
+                self._operations.append({"name": name, "duration": duration, "image size": image_size()})
+
+    def write_bundle(self, settings):
+
+        # Stops the profiling and writes a zip file with the cProfile statistics, both raw and as text, the sampled stacks in the collapsed format of flamegraph.pl, and the session description with the settings and image sizes. Credentials and paths are left out. Returns the path of the bundle
+
+        self._stopped.set()
+        self._sampler.join()
+
+        # The raw statistics are serialized first, building pstats.Stats from the profile empties them
+
+        self._profile.create_stats()
+        raw_statistics=marshal.dumps(self._profile.stats)
+        statistics=StringIO()
+        if len(self._profile.stats)>0:
+            pstats.Stats(self._profile, stream=statistics).sort_stats("cumulative").print_stats(60)
+
+        # Strings can hold credentials, the daemon token or local paths, so only the listed ones are written, others just tell whether they are set
+
+        def public(name, value):
+            if isinstance(value, str) and name not in Profiler.PUBLIC_STRING_SETTINGS:
+                return "set"
+
+            return value
+
+        configurations={configuration_name: {name: public(name, value) for name, value in vars(configuration).items()} for configuration_name, configuration in vars(settings).items() if configuration_name.endswith("_configuration")}
+
+        session={
+            "operations": self._operations,
+            "settings": configurations,
+            "sampling interval": self._interval,
+            "python": sys.version,
+            "platform": platform.platform(),
+            }
+
+        os.makedirs(self._directory, exist_ok=True)
+        bundle_path=path.join(self._directory, f"math_scanner-profile-{time.strftime('%Y%m%d-%H%M%S')}.zip")
+
+        with zipfile.ZipFile(bundle_path, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr("profile.prof", raw_statistics)
+            bundle.writestr("profile.txt", statistics.getvalue())
+            bundle.writestr("stacks.txt", "".join([f"{stack} {count}\n" for stack, count in sorted(self._stacks.items())]))
+            bundle.writestr("session.json", json.dumps(session, indent=1, default=str))
+
+        return bundle_path
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            if self._running==0:
+                continue
+
+            names={thread.ident: thread.name for thread in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident==self._sampler.ident:
+                    continue
+
+                stack=[]
+                while frame!=None:
+                    stack.append(f"{frame.f_code.co_name} ({path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame=frame.f_back
+                stack.append(names.get(ident, str(ident)))
+
+                collapsed=";".join(reversed(stack))
+                self._stacks[collapsed]=self._stacks.get(collapsed, 0)+1
+
+class MathScanner:
+
+    @property
+    def file_name(self): return self._file_name
+
+    @property
+    def image(self):
+        if self._image==None:
+            return None
+
+        return ImageRegion(self._image) if not self.has_columns else self._columns[self._active_column_index][0]
+
+    @property
+    def image_boxes(self):
+        return self._image_boxes if not self.has_columns else self._columns[self._active_column_index][1]
+
+    @property
+    def image_text(self):
+
+        # Texts may have been evicted to save memory, they're recreated from the boxes when needed
+
+        if not self.has_columns:
+            if self._image_text==None:
+                self._image_text="\n".join(["".join([ch.character for ch in l]) for l in self._image_boxes])
+
+            return self._image_text
+
+        region, boxes, text=self._columns[self._active_column_index]
+        if text==None:
+            text="\n".join(["".join([ch.character for ch in l]) for l in boxes])
+            self._columns[self._active_column_index]=(region, boxes, text)
+
+        return text
+
+    @property
+    def skew_angle(self):
+        return self._image.info.get("skew_angle") if self._image!=None else None
+
+    @property
+    def active_column_index(self): return self._active_column_index
+
+    @property
+    def column_count(self): return len(self._columns)
+
+    @property
+    def has_columns(self):
+        return len(self._columns)>0
+
+    @property
+    def page_number(self): return self._page_number
+
+    @property
+    def page_count(self): return len(self._pages)
+
+    @property
+    def project_path(self): return self._project_path
+
+    @property
+    def page_recognized_again(self): return self._page_recognized_again
+
+    @property
+    def is_profiling(self): return self._profiler!=None
+
+    @property
+    def layout_map(self):
+
+        # Built once for every view, the boxes identify it
+
+        if self._layout_map==None or self._layout_map[0] is not self.image_boxes:
+            self._layout_map=(self.image_boxes, LayoutMap(self.image_boxes, self.image.size))
+
+        return self._layout_map[1]
+
+    def __init__(self, settings):
+
+        self._file_name="Untitled"
+        self._image=None
+        self._image_text=""
+        self._image_boxes=[]
+
+        self._left_border=None
+        self._right_border=None
+        self._top_border=None
+        self._bottom_border=None
+
+        self._columns=[]
+        self._active_column_index=0
+
+        self._file_path=None
+        self._recognition_results=[] # Pairs of the recognized box in the image and the Mathpix response
+
+        # Pages of the project. An entry is either an index of the page in the opened project file, or a page dictionary if the page was changed
+
+        self._project=None
+        self._project_path=None
+        self._pages=[]
+        self._page_number=0
+        self._page_recognized_again=False # Whether the current page came from the project but the settings changed since it was saved
+        self._daemon_error=None # The last failure of the daemon not reported to the user yet
+
+        self._settings=settings
+        self._memory_snapshot=None
+        self._profiler=None
+
+        self._formula_candidates=None # The boxes the candidates were found in and the candidates
+        self._layout_map=None # The boxes the map was built from and the map
+        self._speculative_recognitions={} # Boxes of regions in the loaded image: futures of their Mathpix responses
+
+        # All OCR and recognition jobs of the scanner share one scheduler, so background work yields to the user's requests
+
+        configuration=settings.scheduler_configuration
+        self._scheduler=Scheduler(configuration.workers, [configuration.workers, configuration.visible_next_limit, configuration.prefetch_limit, configuration.batch_limit])
+
+        # Columns may be recognized by worker processes, reading the loaded image from shared memory
+
+        self._process_executor=None
+        self._shared_images=SharedImageStore()
+        self._shared_image=None # The loaded image and its handle
+
+        # With the daemon in use, the scanner becomes a thin client, leaving OCR and recognition to it
+
+        self._daemon_client=DaemonClient(settings.daemon_configuration) if settings.daemon_configuration.use_daemon else None
+        self._recognizer=self._daemon_client if self._daemon_client!=None else create_recognizer(settings)
+        self._page_store=PageStore(settings.cache_configuration.directory, settings.cache_configuration.size) if settings.cache_configuration.page_cache else None
+        self._page_index=PageIndex(self._page_store.directory) if self._page_store!=None and settings.cache_configuration.near_duplicates else None
+
+        if settings.memory_configuration.trace:
+            self.start_memory_tracing()
+
+    def load_image_from_file(self, path, priority=Scheduler.INTERACTIVE):
+        self._profiled("load_image_from_file", self._load_image_from_file, path, priority)
+    def _load_image_from_file(self, path, priority):
+
+        previous_page=self._page_state() if self._image!=None else None
+
+        self._image=ImageProcessor.process_image(ImageProcessor.open_image(path, self._settings.input_image_processing_configuration), self._settings.input_image_processing_configuration)
+
+        # Without a project, the loaded image replaces the current one, otherwise it becomes a new page after it
+
+        if self._project_path!=None and len(self._pages)>0:
+            self._pages[self._page_number]=previous_page
+            self._pages.insert(self._page_number+1, None)
+            self._page_number+=1
+        else:
+            self._pages=[None]
+            self._page_number=0
+
+        self._file_path=os.path.abspath(path)
+        self._recognition_results=[]
+        self._speculative_recognitions={}
+        self._release_shared_image()
+        self._file_name=path.split("/")[-1]
+
+        self._page_recognized_again=False
+        self._image_boxes=self._recognize_page(path, priority)
+        self._image_text="\n".join(["".join([ch.character for ch in l]) for l in self._image_boxes])
+
+        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+        self._columns=[]
+        self._active_column_index=0
+
+        self._enforce_memory_budget()
+        self._speculate()
+
+    def place_left_border(self, row, column):
+
+        self._check_coordinates(row, column)
+
+        border=self.image_boxes[row][column]._bottom_left_x
+
+        if self._left_border==None or border<self._left_border:
+            self._left_border=border
+
+            return True
+
+        return False
+    def place_right_border(self, row, column):
+
+        self._check_coordinates(row, column)
+
+        border=self.image_boxes[row][column]._top_right_x
+
+        if self._right_border==None or border>self._right_border:
+            self._right_border=border
+
+            return True
+
+        return False
+    def place_top_border(self, row, column):
+
+        self._check_coordinates(row, column)
+
+        border=self.image_boxes[row][column]._top_right_y
+
+        if self._top_border==None or border>self._top_border:
+            self._top_border=border
+
+            return True
+
+        return False
+    def place_bottom_border(self, row, column):
+
+        self._check_coordinates(row, column)
+
+        border=self.image_boxes[row][column]._bottom_left_y
+
+        if self._bottom_border==None or border<self._bottom_border:
+            self._bottom_border=border
+
+            return True
+
+        return False
+
+    def remove_left_border(self):
+        if self._left_border!=None:
+            self._left_border=None
+
+            return True
+
+        return False
+    def remove_right_border(self):
+        if self._right_border!=None:
+            self._right_border=None
+
+            return True
+
+        return False
+    def remove_top_border(self):
+        if self._top_border!=None:
+            self._top_border=None
+
+            return True
+
+        return False
+    def remove_bottom_border(self):
+        if self._bottom_border!=None:
+            self._bottom_border=None
+
+            return True
+
+        return False
+
+    def remove_all_borders(self):
+        if self._left_border!=None or self._right_border!=None or self._top_border!=None or self._bottom_border!=None:
+            self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+
+            return True
+
+        return False
+
+    def switch_horizontal_borders(self):
+        self._top_border, self._bottom_border=self._bottom_border, self._top_border
+    def switch_vertical_borders(self):
+        self._left_border, self._right_border=self._right_border, self._left_border
+
+    def left_edge_distance(self, row, column):
+        self._check_coordinates(row, column)
+
+        left, _, _, _=self.layout_map.character(row, column)
+
+        return int(left/self.layout_map.size[0]*100)
+    def right_edge_distance(self, row, column):
+        self._check_coordinates(row, column)
+
+        _, _, right, _=self.layout_map.character(row, column)
+        image_width=self.layout_map.size[0]
+
+        return int((image_width-right)/image_width*100)
+    def top_edge_distance(self, row, column):
+        self._check_coordinates(row, column)
+
+        _, _, _, top=self.layout_map.character(row, column)
+        image_height=self.layout_map.size[1]
+
+        return int((image_height-top)/image_height*100)
+    def bottom_edge_distance(self, row, column):
+        self._check_coordinates(row, column)
+
+        _, bottom, _, _=self.layout_map.character(row, column)
+
+        return int(bottom/self.layout_map.size[1]*100)
+
+    def bordered_region_width(self):
+
+        image_width=self.image.size[0]
+        if self._left_border==None or self._right_border==None:
+            left_border=self._left_border if self._left_border!=None else 0
+            right_border=self._right_border if self._right_border!=None else image_width
+        else:
+            left_border, right_border=(self._left_border, self._right_border) if self._left_border<self._right_border else (self._right_border, self._left_border)
+
+        return int((right_border-left_border)/image_width*100)
+    def bordered_region_height(self):
+
+        image_height=self.image.size[1]
+        if self._top_border==None or self._bottom_border==None:
+            top_border=self._top_border if self._top_border!=None else image_height
+            bottom_border=self._bottom_border if self._bottom_border!=None else 0
+        else:
+            top_border, bottom_border=(self._top_border, self._bottom_border) if self._top_border>self._bottom_border else (self._bottom_border, self._top_border)
+
+        return int((top_border-bottom_border)/image_height*100)
+
+    def character_width(self, row, column):
+        self._check_coordinates(row, column)
+
+        left, _, right, _=self.layout_map.character(row, column)
+
+        return int(right-left)
+    def character_height(self, row, column):
+        self._check_coordinates(row, column)
+
+        _, bottom, _, top=self.layout_map.character(row, column)
+
+        return int(top-bottom)
+
+    def indentation(self, row):
+
+        # Returns the indentation level of the line, starting with 1 for the leftmost lines, and the number of levels
+
+        self._check_coordinates(row, 0)
+
+        return int(self.layout_map.level[row])+1, len(self.layout_map.indentations)
+    def line_spacing(self, row):
+
+        # Returns the distance of the line's baseline from the previous one, relative to the usual spacing, or None for the first line
+
+        self._check_coordinates(row, 0)
+
+        spacing=self.layout_map.spacing[row]
+        if not np.isfinite(spacing) or self.layout_map.median_spacing<=0:
+            return None
+
+        return float(spacing/self.layout_map.median_spacing)
+    def margins(self):
+
+        # Returns the left, right, top and bottom margins in % of the image size
+
+        width, height=self.layout_map.size
+        left, right, top, bottom=self.layout_map.margins
+
+        return int(left/width*100), int(right/width*100), int(top/height*100), int(bottom/height*100)
+    def layout_changes(self, previous_row, row):
+
+        # Describes what changed in the layout when moving between the lines, meant to be announced on every line move
+
+        layout_map=self.layout_map
+        if row<0 or row>=len(layout_map.level) or previous_row<0 or previous_row>=len(layout_map.level):
+            return []
+
+        changes=[]
+        if layout_map.level[row]!=layout_map.level[previous_row] and layout_map.level[row]>=0:
+            changes.append(f"indentation {layout_map.level[row]+1}")
+
+        # A bigger gap above the line usually starts a paragraph or a display formula
+
+        if row==previous_row+1 and layout_map.median_spacing>0 and layout_map.spacing[row]>1.5*layout_map.median_spacing:
+            changes.append("space above")
+
+        return changes
+
+    def get_bordered_region(self):
+        assert self.image!=None
+
+        return self.image.crop(self._bordered_box())
+    def refine_bordered_region(self):
+        assert self.image!=None
+
+        # Only the bordered region is upscaled and recognized again, its boxes are then converted to the coordinates of the view and replace the original ones
+
+        scale_factor=self._settings.tesseract_configuration.refinement_scale_factor
+        left, top, right, bottom=self._bordered_box()
+        offset_y=self.image.size[1]-bottom # The bottom edge of the region in Tesseract coordinates
+
+        image=ImageProcessor._scale(self.image.crop((left, top, right, bottom)).materialize(), scale_factor)
+        refined_boxes=self._scheduler.submit(Scheduler.INTERACTIVE, self._segment_image, image).result()
+        refined_lines=[[CharacterBox(ch.character, left+ch.bottom_left_x//scale_factor, offset_y+ch.bottom_left_y//scale_factor, left+-(-ch.top_right_x//scale_factor), offset_y+-(-ch.top_right_y//scale_factor)) for ch in line if ch.character!=" "] for line in refined_boxes]
+
+        def is_inside(ch):
+            middle_x=ch.bottom_left_x+ch.width/2
+            middle_y=ch.bottom_left_y+ch.height/2
+
+            return middle_x>=left and middle_x<right and middle_y>=offset_y and middle_y<offset_y+bottom-top
+
+        # Spaces are recomputed, as the refined characters may have different distances
+
+        lines=[[ch for ch in line if ch.character!=" " and not is_inside(ch)] for line in self.image_boxes]
+        lines=[line for line in lines if len(line)>0]
+
+        for refined_line in refined_lines:
+            if len(refined_line)==0:
+                continue
+
+            line_y=sorted([ch.bottom_left_y+ch.height//2 for ch in refined_line])[len(refined_line)//2]
+
+            for line in lines:
+                if line_y>=min([ch.bottom_left_y for ch in line]) and line_y<=max([ch.top_right_y for ch in line]):
+                    line.extend(refined_line)
+                    break
+            else:
+                lines.append(refined_line)
+
+        for line in lines:
+            line.sort(key=lambda i: i.bottom_left_x+int(i.width/2))
+            insert_spaces(line)
+        lines.sort(key=lambda line: sorted([ch.bottom_left_y+ch.height//2 for ch in line])[len(line)//2], reverse=True)
+
+        self._set_image_boxes(lines)
+
+        return sum([len(line) for line in refined_lines])
+    def _bordered_box(self, borders=None):
+
+        # The borders default to the placed ones
+
+        left_border, right_border, top_border, bottom_border=borders if borders!=None else (self._left_border, self._right_border, self._top_border, self._bottom_border)
+
+        if left_border==None or right_border==None:
+            left_border=left_border if left_border!=None else 0
+            right_border=right_border if right_border!=None else self.image.size[0]-1
+        else:
+            left_border, right_border=(left_border, right_border) if left_border<right_border else (right_border, left_border)
+
+        if top_border==None or bottom_border==None:
+            top_border=top_border if top_border!=None else self.image.size[1]-1
+            bottom_border=bottom_border if bottom_border!=None else 0
+        else:
+            top_border, bottom_border=(top_border, bottom_border) if top_border>bottom_border else (bottom_border, top_border)
+
+        if left_border<0: left_border=0
+        if right_border>=self.image.size[0]: right_border=self.image.size[0]-1
+        if bottom_border<0: bottom_border=0
+        if top_border>=self.image.size[1]: top_border=self.image.size[1]-1
+
+        # Tesseract and PIL use different coordinates system. While Tesseract has its 0;0 point in bottom left corner, PIL uses the top left one. It's therefore needed to convert our values
+
+        top_border=self.image.size[1]-1-top_border
+        bottom_border=self.image.size[1]-1-bottom_border
+
+        return (left_border, top_border, right_border+1, bottom_border+1)
+
+    def recognize(self, region):
+        return self._profiled("recognize", self._recognize, region)
+    def _recognize(self, region):
+
+        # Regions recognized speculatively in the background are taken from there, waiting for the result if it's still on the way. A speculation still waiting in the queue becomes interactive. Cancelled or failed speculations, including those answered by an error response, are dropped and the region is recognized again
+
+        future=self._speculative_recognitions.get(region.box)
+        if future!=None:
+            self._scheduler.promote(future, Scheduler.INTERACTIVE)
+
+            try:
+                succeeded="error" not in json.loads(future.result())
+            except Exception:
+                succeeded=False
+
+            if not succeeded:
+                self._speculative_recognitions.pop(region.box, None)
+                future=None
+
+        if future==None:
+            future=self._scheduler.submit(Scheduler.INTERACTIVE, self._recognize_region, region)
+        result=future.result()
+        self._recognition_results.append((region.box, result))
+
+        return result
+    def formula_candidates(self):
+        if self._formula_candidates==None or self._formula_candidates[0] is not self.image_boxes:
+            self._formula_candidates=(self.image_boxes, find_formula_candidates(self.image_boxes))
+
+        return self._formula_candidates[1]
+    def border_formula_candidate(self, index):
+        candidate=self.formula_candidates()[index]
+
+        self._left_border, self._right_border, self._top_border, self._bottom_border=candidate.left, candidate.right, candidate.top, candidate.bottom
+
+        return candidate
+
+    def open_project(self, file_path):
+        project=Project(file_path)
+
+        if project.page_count==0:
+            project.close()
+            raise ValueError(f"Project {file_path} has no pages.")
+
+        try:
+            self._restore_page(project.page(0))
+        except (FileNotFoundError, ValueError):
+            project.close()
+            raise
+
+        if self._project!=None:
+            self._project.close()
+
+        self._project=project
+        self._project_path=file_path
+        self._pages=list(range(project.page_count))
+        self._page_number=0
+    def save_project(self, file_path):
+        assert self._image!=None
+
+        self._pages[self._page_number]=self._page_state()
+
+        # Pages still in the old file are read one by one while writing, so the project is never fully loaded to memory
+
+        pages=(page if isinstance(page, dict) else self._project.page(page) for page in self._pages)
+
+        if self._project!=None and self._project_path==file_path:
+
+            # The file being replaced must be read completely before it is closed, as the new one takes its place only at the end
+
+            temporary_path=f"{file_path}.saving"
+            Project.write(temporary_path, pages)
+            self._project.close()
+            os.replace(temporary_path, file_path)
+        else:
+            Project.write(file_path, pages)
+            if self._project!=None:
+                self._project.close()
+
+        self._project=Project(file_path)
+        self._project_path=file_path
+        self._pages=list(range(self._project.page_count))
+    def switch_to_page(self, page_number):
+        assert page_number>=0 and page_number<len(self._pages)
+
+        current_page=self._page_state()
+
+        page=self._pages[page_number]
+        self._restore_page(page if isinstance(page, dict) else self._project.page(page))
+
+        self._pages[self._page_number]=current_page
+        self._page_number=page_number
+
+    def split_to_columns(self):
+        self._profiled("split_to_columns", self._split_to_columns)
+    def _split_to_columns(self):
+        assert self._image!=None
+
+        left_border=self._left_border if self._left_border!=None else 0
+        right_border=self._right_border if self._right_border!=None else self.image.size[0]-1
+
+        if left_border>right_border:
+            left_border, right_border=right_border, left_border
+
+        middle_line=left_border+int((right_border-left_border)/2) # Is the index of column of pixels to the left of the middle line. When cropping the left region, we must increase it by 1 to include it in the cropped image.
+
+        self._replace_active_column([middle_line+1])
+    def detect_columns(self):
+        assert self._image!=None
+
+        # Boxes of already recognized text are much cheaper to analyze than pixels, the image is used only if there's no text
+
+        if len(self.image_boxes)>0:
+            profile=boxes_profile(self.image_boxes, self.image.size[0])
+        else:
+            profile=ink_profile(self.image.materialize())
+
+        return find_column_gutters(profile)
+    def split_to_detected_columns(self):
+        assert self._image!=None
+
+        gutters=self.detect_columns()
+        if len(gutters)==0:
+            return False
+
+        self._replace_active_column(gutters)
+
+        return True
+    def switch_to_previous_column(self):
+        assert self.has_columns
+
+        self._active_column_index-=1
+        if self._active_column_index<0:
+            self._active_column_index=len(self._columns)-1
+
+        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+
+        self._speculate()
+    def switch_to_next_column(self):
+        assert self.has_columns
+
+        self._active_column_index+=1
+        self._active_column_index%=len(self._columns)
+
+        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+
+        self._speculate()
+    def cancel_columns(self):
+        self._columns=[]
+
+        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+
+    def scheduler_metrics(self):
+        return self._scheduler.metrics()
+    def recognition_statistics(self):
+        if self._daemon_client!=None:
+            return self._daemon_client.status()["recognition"]
+
+        return self._recognizer.statistics()
 
-        if self._right_border==None or border>self._right_border:
-            self._right_border=border
+    def start_profiling(self, directory=None):
+        self._profiler=Profiler(directory if directory!=None else path.join(appdirs.user_log_dir("math_scanner"), "profiles"))
+    def stop_profiling(self):
 
-            return True
+        # Writes the profile bundle and returns its path
 
-        return False
-    def place_top_border(self, row, column):
+        profiler=self._profiler
+        self._profiler=None
 
-        self._check_coordinates(row, column)
+        return profiler.write_bundle(self._settings)
+    def _profiled(self, name, function, *args):
+        if self._profiler==None:
+            return function(*args)
 
-        border=self.image_boxes[row][column]._top_right_y
+        return self._profiler.run(name, lambda: list(self._image.size) if self._image!=None else None, function, *args)
 
-        if self._top_border==None or border>self._top_border:
-            self._top_border=border
+    def _speculate(self):
 
-            return True
+        # Sends the most promising formula candidates of the current view to Mathpix in the background, so that recognizing them later is instant. Requests of the previous view, which didn't start yet, are cancelled
 
-        return False
-    def place_bottom_border(self, row, column):
+        count=self._settings.mathpix_configuration.speculative_candidates
+        if count<=0 or self._image==None or (self._daemon_client==None and self._settings.mathpix_configuration.app_id==None):
+            return
 
-        self._check_coordinates(row, column)
+        for box, future in list(self._speculative_recognitions.items()):
+            if future.cancel():
+                del self._speculative_recognitions[box]
 
-        border=self.image_boxes[row][column]._bottom_left_y
+        for candidate in self.formula_candidates()[:count]:
+            region=self.image.crop(self._bordered_box((candidate.left, candidate.right, candidate.top, candidate.bottom)))
 
-        if self._bottom_border==None or border<self._bottom_border:
-            self._bottom_border=border
+            if region.box not in self._speculative_recognitions:
+                self._speculative_recognitions[region.box]=self._scheduler.submit(Scheduler.PREFETCH, self._recognize_region, region)
+    def _recognize_region(self, region):
+        image=ImageProcessor.process_image(region.materialize(), self._settings.output_image_processing_configuration)
 
-            return True
+        # Mathpix credentials are usually only in the daemon's settings, so its failure is reported as an error response rather than recognized locally
 
-        return False
+        try:
+            return self._recognizer.recognize(image)
+        except DaemonError as e:
+            return json.dumps({"error": "Daemon unavailable", "error_info": {"id": "daemon_error", "message": str(e)}})
+    def _recognize_page(self, file_path, priority=Scheduler.INTERACTIVE):
+
+        # Pages recognized before, for example by the folder watcher, are taken from the page store
+
+        key=PageStore.key(file_path, self._settings) if self._page_store!=None else None
+        boxes=self._page_store.get(key) if key!=None else None
+        if boxes==None:
+            boxes=self._load_near_duplicate_boxes(key)
+        if boxes==None:
+            boxes=self._scheduler.submit(priority, self._segment_image, self._image).result()
+            if key!=None:
+                self._page_store.put(key, boxes)
+                if self._page_index!=None:
+                    self._page_index.add(self._image, PageStore.settings_signature(self._settings), key)
+
+        return boxes
+    def _evict_speculative_recognitions(self):
+        self._speculative_recognitions={box: future for box, future in self._speculative_recognitions.items() if not future.done()}
+    def _load_near_duplicate_boxes(self, key):
+
+        # A page looking nearly the same as an already recognized one reuses its boxes, moved by the offset between the images
+
+        if self._page_index==None:
+            return None
+
+        match=self._page_index.find(self._image, PageStore.settings_signature(self._settings))
+        if match==None:
+            return None
+
+        duplicate_key, dx, dy=match
+        boxes=self._page_store.get(duplicate_key)
+        if boxes==None:
+            return None
+
+        boxes=shift_boxes(boxes, dx, dy)
+        if not PageIndex.boxes_fit(self._image, boxes):
+            return None
+
+        self._page_store.put(key, boxes)
+
+        return boxes
+    def _page_state(self):
+        views=[{"box": None, "boxes": self._image_boxes}]+[{"box": list(region.box), "boxes": boxes} for region, boxes, _ in self._columns]
+
+        return {
+            "path": self._file_path,
+            "signature": PageStore.settings_signature(self._settings),
+            "size": list(self._image.size),
+            "borders": [self._left_border, self._right_border, self._top_border, self._bottom_border],
+            "active column": self._active_column_index,
+            "views": views,
+            "recognitions": [{"box": list(box), "response": response} for box, response in self._recognition_results],
+            }
+    def page_result(self):
 
-    def remove_left_border(self):
-        if self._left_border!=None:
-            self._left_border=None
+        # The current page in a serializable form, as written by the batch processing
 
-            return True
+        result=self._page_state()
+        result["views"]=[{"box": view["box"], "text": "\n".join(["".join([ch.character for ch in l]) for l in view["boxes"]]), "boxes": boxes_to_list(view["boxes"])} for view in result["views"]]
+        result["column gutters"]=find_column_gutters(boxes_profile(self._image_boxes, self._image.size[0]))
 
-        return False
-    def remove_right_border(self):
-        if self._right_border!=None:
-            self._right_border=None
+        return result
+    def _restore_page(self, page):
 
-            return True
+        # The image is loaded again to allow cropping, but its text comes from the page. If the image can't be loaded, the current state stays untouched
 
-        return False
-    def remove_top_border(self):
-        if self._top_border!=None:
-            self._top_border=None
+        file_path=page["path"]
+        configuration=self._settings.input_image_processing_configuration
 
-            return True
+        self._image=ImageProcessor.process_image(ImageProcessor.open_image(file_path, configuration), configuration)
+        self._file_path=file_path
+        self._file_name=os.path.basename(file_path)
 
-        return False
-    def remove_bottom_border(self):
-        if self._bottom_border!=None:
-            self._bottom_border=None
+        self._speculative_recognitions={}
+        self._release_shared_image()
 
-            return True
+        # The boxes of the page are in the coordinates of the image processed with the settings it was saved with. If they have changed since, the page is recognized again and its columns, borders and recognitions, which would no longer fit the image, are dropped. Projects saved without the signature are trusted
 
-        return False
+        signature=PageStore.settings_signature(self._settings)
+        self._page_recognized_again=page.get("signature", signature)!=signature
 
-    def remove_all_borders(self):
-        if self._left_border!=None or self._right_border!=None or self._top_border!=None or self._bottom_border!=None:
+        if self._page_recognized_again:
+            self._image_boxes=self._recognize_page(file_path)
+            self._columns=[]
+            self._active_column_index=0
             self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+            self._recognition_results=[]
+        else:
+            self._image_boxes=page["views"][0]["boxes"]
+            self._columns=[(ImageRegion(self._image, tuple(view["box"])), view["boxes"], "\n".join(["".join([ch.character for ch in l]) for l in view["boxes"]])) for view in page["views"][1:]]
+            self._active_column_index=page["active column"] if page["active column"]<max(len(self._columns), 1) else 0
+            self._left_border, self._right_border, self._top_border, self._bottom_border=page["borders"]
+            self._recognition_results=[(tuple(i["box"]), i["response"]) for i in page["recognitions"]]
+        self._image_text="\n".join(["".join([ch.character for ch in l]) for l in self._image_boxes])
 
-            return True
+        self._enforce_memory_budget()
+        self._speculate()
+    def _segment_image(self, image):
 
-        return False
+        # When the daemon isn't available, the text is recognized locally
 
-    def switch_horizontal_borders(self):
-        self._top_border, self._bottom_border=self._bottom_border, self._top_border
-    def switch_vertical_borders(self):
-        self._left_border, self._right_border=self._right_border, self._left_border
+        if self._daemon_client!=None:
+            try:
+                return self._daemon_client.segment_image(image)
+            except DaemonError as e:
+                print(f"{e} Recognizing locally.", file=sys.stderr)
+                self._daemon_error=str(e)
 
-    def left_edge_distance(self, row, column):
-        self._check_coordinates(row, column)
+        return segment_image(image, self._settings.tesseract_configuration)
+    def take_daemon_error(self):
 
-        image_width=self.image.size[0]
-        character_box=self.image_boxes[row][column]
-        distance=character_box.bottom_left_x
+        # Returns the last failure of the daemon since the previous call, or None
 
-        return int(distance/image_width*100)
-    def right_edge_distance(self, row, column):
-        self._check_coordinates(row, column)
+        message, self._daemon_error=self._daemon_error, None
 
-        image_width=self.image.size[0]
-        character_box=self.image_boxes[row][column]
-        distance=image_width-character_box.top_right_x
+        return message
+    def _share_image(self):
 
-        return int(distance/image_width*100)
-    def top_edge_distance(self, row, column):
-        self._check_coordinates(row, column)
+        # The image is copied to shared memory once per page, the workers then get just handles of their rectangles
 
-        image_height=self.image.size[1]
-        character_box=self.image_boxes[row][column]
-        distance=image_height-character_box.top_right_y
+        if self._shared_image==None or self._shared_image[0] is not self._image:
+            self._release_shared_image()
+            self._shared_image=(self._image, self._shared_images.put(self._image))
 
-        return int(distance/image_height*100)
-    def bottom_edge_distance(self, row, column):
-        self._check_coordinates(row, column)
+        # The workers are spawned instead of forked, forking a process already running the scheduler, speech and profiler threads can leave locks held in the children forever
 
-        image_height=self.image.size[1]
-        character_box=self.image_boxes[row][column]
-        distance=character_box.bottom_left_y
+        if self._process_executor==None:
+            self._process_executor=ProcessPoolExecutor(max_workers=self._settings.tesseract_configuration.worker_processes, mp_context=multiprocessing.get_context("spawn"))
 
-        return int(distance/image_height*100)
+        return self._shared_image[1]
+    def _segment_in_process(self, handle, region):
+        return self._process_executor.submit(segment_shared_image, handle.crop(region.box), self._settings.tesseract_configuration).result()
+    def _release_shared_image(self):
+        if self._shared_image!=None:
+            self._shared_images.release(self._shared_image[1])
+            self._shared_image=None
+    def close(self):
+        self._scheduler.shutdown(wait=False)
+        if self._process_executor!=None:
+            self._process_executor.shutdown()
 
-    def bordered_region_width(self):
+        self._shared_image=None
+        self._shared_images.close()
+    def _set_image_boxes(self, boxes):
+        text="\n".join(["".join([ch.character for ch in l]) for l in boxes])
 
-        image_width=self.image.size[0]
-        if self._left_border==None or self._right_border==None:
-            left_border=self._left_border if self._left_border!=None else 0
-            right_border=self._right_border if self._right_border!=None else image_width
+        if self.has_columns:
+            self._columns[self._active_column_index]=(self._columns[self._active_column_index][0], boxes, text)
         else:
-            left_border, right_border=(self._left_border, self._right_border) if self._left_border<self._right_border else (self._right_border, self._left_border)
+            self._image_boxes, self._image_text=boxes, text
 
-        return int((right_border-left_border)/image_width*100)
-    def bordered_region_height(self):
+        self._enforce_memory_budget()
+    def _replace_active_column(self, splits):
 
-        image_height=self.image.size[1]
-        if self._top_border==None or self._bottom_border==None:
-            top_border=self._top_border if self._top_border!=None else image_height
-            bottom_border=self._bottom_border if self._bottom_border!=None else 0
+        # Splits the active column (or the whole image) on the given x coordinates and recognizes the new columns in parallel
+
+        image=self.image
+        edges=[0]+splits+[image.size[0]]
+        regions=[image.crop((edges[i], 0, edges[i+1], image.size[1])) for i in range(len(edges)-1)]
+
+        # Worker processes are driven through the scheduler too, so its limits cover them. The first new column becomes the active one, the user waits for it first
+
+        if self._settings.tesseract_configuration.worker_processes>0 and self._daemon_client==None:
+            handle=self._share_image()
+            segment=lambda region: self._segment_in_process(handle, region)
         else:
-            top_border, bottom_border=(self._top_border, self._bottom_border) if self._top_border>self._bottom_border else (self._bottom_border, self._top_border)
+            segment=lambda region: self._segment_image(region.materialize())
 
-        return int((top_border-bottom_border)/image_height*100)
+        futures=[self._scheduler.submit(Scheduler.INTERACTIVE if i==0 else Scheduler.VISIBLE_NEXT, segment, region) for i, region in enumerate(regions)]
+        boxes=[future.result() for future in futures]
 
-    def character_width(self, row, column):
-        self._check_coordinates(row, column)
+        columns=[(region, region_boxes, "\n".join(["".join([ch.character for ch in l]) for l in region_boxes])) for region, region_boxes in zip(regions, boxes)]
 
-        character_box=self.image_boxes[row][column]
+        if len(self._columns)>0:
+            del self._columns[self._active_column_index]
+        else:
+            self._active_column_index=0
 
-        return character_box.top_right_x-character_box.bottom_left_x
-    def character_height(self, row, column):
-        self._check_coordinates(row, column)
+        self._columns[self._active_column_index:self._active_column_index]=columns
 
-        character_box=self.image_boxes[row][column]
+        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
 
-        return character_box.top_right_y-character_box.bottom_left_y
+        self._enforce_memory_budget()
+        self._speculate()
 
-    def get_bordered_region(self):
-        assert self.image!=None
+    def columns_memory_usage(self):
 
-        if self._left_border==None or self._right_border==None:
-            left_border=self._left_border if self._left_border!=None else 0
-            right_border=self._right_border if self._right_border!=None else self.image.size[0]-1
-        else:
-            left_border, right_border=(self._left_border, self._right_border) if self._left_border<self._right_border else (self._right_border, self._left_border)
+        # Columns hold only views of the loaded image, so the measure covers the views, their boxes and texts, not pixels
 
-        if self._top_border==None or self._bottom_border==None:
-            top_border=self._top_border if self._top_border!=None else self.image.size[1]-1
-            bottom_border=self._bottom_border if self._bottom_border!=None else 0
-        else:
-            top_border, bottom_border=(self._top_border, self._bottom_border) if self._top_border>self._bottom_border else (self._bottom_border, self._top_border)
+        return sys.getsizeof(self._columns)+sum([self._column_memory_usage(column) for column in self._columns])
+    def memory_report(self):
 
-        if left_border<0: left_border=0
-        if right_border>=self.image.size[0]: right_border=self.image.size[0]-1
-        if bottom_border<0: bottom_border=0
-        if top_border>=self.image.size[1]: top_border=self.image.size[1]-1
+        # Sizes in bytes of everything the scanner holds, split to the current page, its columns, other pages of the project kept in memory, by their numbers, and caches. The caches hold only data, which can be recomputed
 
-        # Tesseract and PIL use different coordinates system. While Tesseract has its 0;0 point in bottom left corner, PIL uses the top left one. It's therefore needed to convert our values
+        caches=self._cache_memory_usage()
 
-        top_border=self.image.size[1]-1-top_border
-        bottom_border=self.image.size[1]-1-bottom_border
+        report={
+            "image": image_memory_usage(self._image),
+            "page boxes": boxes_memory_usage(self._image_boxes),
+            "columns": [self._column_memory_usage(column) for column in self._columns],
+            "other pages": {i+1: sum([boxes_memory_usage(view["boxes"]) for view in page["views"]]) for i, page in enumerate(self._pages) if isinstance(page, dict) and i!=self._page_number},
+            "recognition results": sum([sys.getsizeof(response) for _, response in self._recognition_results]),
+            "caches": caches,
+            }
+        report["total"]=report["image"]+report["page boxes"]+sum(report["columns"])+sum(report["other pages"].values())+report["recognition results"]+sum(caches.values())
 
-        return self.image.crop((left_border, top_border, right_border+1, bottom_border+1))
+        return report
+    def format_memory_report(self, report=None):
+        report=report if report!=None else self.memory_report()
 
-    def recognize(self, image):
-        return self._mathpix_recognizer.recognize(ImageProcessor.process_image(image, self._settings.output_image_processing_configuration))
+        lines=[
+            f"Total: {format_memory_size(report['total'])}",
+            f"Image: {format_memory_size(report['image'])}",
+            f"Page boxes: {format_memory_size(report['page boxes'])}",
+            ]
+        lines+=[f"Column {i+1}: {format_memory_size(size)}" for i, size in enumerate(report["columns"])]
+        lines+=[f"Page {number}: {format_memory_size(size)}" for number, size in report["other pages"].items()]
+        lines+=[f"Recognition results: {format_memory_size(report['recognition results'])}"]
+        lines+=[f"Cache {name}: {format_memory_size(size)}" for name, size in report["caches"].items()]
 
-    def split_to_columns(self):
-        assert self._image!=None
+        if self._memory_snapshot!=None:
+            lines+=["", "Allocation changes since the last report:"]+self.memory_trace_difference()
 
-        left_border=self._left_border if self._left_border!=None else 0
-        right_border=self._right_border if self._right_border!=None else self.image.size[0]-1
+        return "\n".join(lines)
 
-        if left_border>right_border:
-            left_border, right_border=right_border, left_border
+    def start_memory_tracing(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
 
-        middle_line=left_border+int((right_border-left_border)/2) # Is the index of column of pixels to the left of the middle line. When cropping the left region, we must increase it by 1 to include it in the cropped image.
+        self._memory_snapshot=tracemalloc.take_snapshot()
+    def memory_trace_difference(self, limit=10):
 
-        left_column=self.image.crop((0, 0, middle_line+1, self.image.size[1]))
-        right_column=self.image.crop((middle_line+1, 0, self._image.size[0], self.image.size[1]))
+        # Compares the allocations with the previous snapshot, which is then replaced by the current state
 
-        left_column_boxes=segment_image(left_column, self._settings.tesseract_configuration)
-        right_column_boxes=segment_image(right_column, self._settings.tesseract_configuration)
+        snapshot=tracemalloc.take_snapshot()
+        statistics=snapshot.compare_to(self._memory_snapshot, "lineno")
+        self._memory_snapshot=snapshot
 
-        left_column_text="\n".join(["".join([ch.character for ch in l]) for l in left_column_boxes])
-        right_column_text="\n".join(["".join([ch.character for ch in l]) for l in right_column_boxes])
+        return [str(statistic) for statistic in statistics[:limit]]
 
-        if len(self._columns)>0:
-            del self._columns[self._active_column_index]
-        else:
-            self._active_column_index=0
+    def _cache_memory_usage(self):
+        caches={
+            "page index": self._page_index.memory_usage() if self._page_index!=None else 0,
+            "shared images": self._shared_images.memory_usage(),
+            "layout map": sum([value.nbytes for value in vars(self._layout_map[1]).values() if isinstance(value, np.ndarray)]) if self._layout_map!=None else 0,
+            "speculative recognitions": sum([sys.getsizeof(future.result()) for future in self._speculative_recognitions.values() if future.done() and not future.cancelled() and future.exception()==None]),
+            "texts": sys.getsizeof(self._image_text) if self._image_text!=None else 0,
+            }
+        caches["texts"]+=sum([sys.getsizeof(text) for _, _, text in self._columns if text!=None])
 
-        self._columns.insert(self._active_column_index, (left_column, left_column_boxes, left_column_text))
-        self._columns.insert(self._active_column_index+1, (right_column, right_column_boxes, right_column_text))
+        return caches
+    def _column_memory_usage(self, column):
+        region, boxes, text=column
 
-        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
-    def switch_to_previous_column(self):
-        assert self.has_columns
+        return sys.getsizeof(column)+region.memory_usage()+boxes_memory_usage(boxes)+(sys.getsizeof(text) if text!=None else 0)
+    def _enforce_memory_budget(self):
 
-        self._active_column_index-=1
-        if self._active_column_index<0:
-            self._active_column_index=len(self._columns)-1
+        # When over the soft budget, caches are emptied one by one, until the usage fits. The whole usage is measured once, then just the caches, which are cheap to measure, are compared before and after each eviction
 
-        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
-    def switch_to_next_column(self):
-        assert self.has_columns
+        budget=self._settings.memory_configuration.soft_budget*1024*1024
+        if budget<=0:
+            return
 
-        self._active_column_index+=1
-        self._active_column_index%=len(self._columns)
+        report=self.memory_report()
+        total, caches=report["total"], report["caches"]
 
-        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
-    def cancel_columns(self):
-        self._columns=[]
+        for name, evict in (("texts", self._evict_texts), ("layout map", self._evict_layout_map), ("shared images", self._release_shared_image), ("page index", self._evict_page_index), ("speculative recognitions", self._evict_speculative_recognitions)):
+            if total<=budget:
+                return
 
-        self._left_border, self._right_border, self._top_border, self._bottom_border=None, None, None, None
+            evict()
+
+            remaining=self._cache_memory_usage()
+            total-=caches[name]-remaining[name]
+            caches=remaining
+    def _evict_texts(self):
+        self._image_text=None if self.has_columns else self._image_text
+        self._columns=[(region, boxes, text if i==self._active_column_index else None) for i, (region, boxes, text) in enumerate(self._columns)]
+    def _evict_layout_map(self):
+        self._layout_map=None
+    def _evict_page_index(self):
+        if self._page_index!=None:
+            self._page_index.unload()
 
     def _check_coordinates(self, row, column):
 
@@ -729,6 +3734,8 @@ class LinuxSpeech:
 
     def speak(self, text):
         self._connection.speak(text)
+    def stop(self):
+        self._connection.cancel()
 
     def release(self):
         self._connection.close()
@@ -740,13 +3747,122 @@ class WindowsSpeech:
 
     def speak(self, text):
         tolk.speak(text)
+    def stop(self):
+        tolk.silence()
 
     def release(self):
         tolk.unload()
+class SpeechQueue:
+
+    # Passes messages to a platform speech class on a dedicated thread, so event handlers never wait for speech. A new message replaces a waiting one of the same kind and interrupts one of the same kind still being spoken, so repeated shortcuts announce only the latest value
+
+    LOW=0
+    NORMAL=1
+    HIGH=2 # Interrupts anything being spoken
+
+    def __init__(self, speech):
+
+        self._speech=speech
+
+        self._condition=threading.Condition()
+        self._pending=[] # Tuples of priority, sequence number, kind, text and whether to interrupt
+        self._sequence=0
+        self._spoken_kind=None # The kind of the last message passed to speech
+        self._running=True
+
+        self._thread=threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def speak(self, text, kind=None, priority=NORMAL):
+        with self._condition:
+            if kind!=None:
+                self._pending=[message for message in self._pending if message[2]!=kind]
+
+            self._sequence+=1
+            self._pending.append((priority, self._sequence, kind, text, priority==SpeechQueue.HIGH or (kind!=None and kind==self._spoken_kind)))
+            self._condition.notify()
+
+    def release(self):
+        with self._condition:
+            self._running=False
+            self._condition.notify()
+
+        self._thread.join()
+        self._speech.release()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and len(self._pending)==0:
+                    self._condition.wait()
+
+                if not self._running:
+                    return
+
+                # The most important message goes first, the oldest one among equally important
+
+                message=min(self._pending, key=lambda message: (-message[0], message[1]))
+                self._pending.remove(message)
+                _, _, kind, text, interrupt=message
+                self._spoken_kind=kind
+
+            if interrupt:
+                self._speech.stop()
+            self._speech.speak(text)
+
+class TextWindow:
+
+    # Holds the text of a view line by line, exposing only a window of lines to the text control. Also maps the caret positions in the window to rows and columns of the view's character boxes, which differ from the character positions when Tesseract returns a box with multiple characters
+
+    SIZE=400
+    MARGIN=40 # The window moves when the caret gets this close to its edge
+
+    @property
+    def start(self): return self._start
+
+    @property
+    def end(self):
+        return min(self._start+TextWindow.SIZE, len(self._lines))
+
+    def __init__(self, boxes):
+
+        self._lines=["".join([ch.character for ch in line]) for line in boxes]
+        self._box_indices={row: [i for i, ch in enumerate(line) for _ in ch.character] for row, line in enumerate(boxes) if any([len(ch.character)!=1 for ch in line])}
+        self._start=0
+
+        self.caret=(0, 0) # Row and column of the box with the caret, kept while the view is not shown
+
+    def text(self):
+        return "\n".join(self._lines[self._start:self.end])
+
+    def to_boxes(self, window_row, window_column):
+        row=self._start+window_row
+
+        if row in self._box_indices:
+            indices=self._box_indices[row]
+            return row, indices[window_column] if window_column<len(indices) else len(indices)
+
+        return row, window_column
+    def to_window(self, row, column):
+        if row in self._box_indices:
+            indices=self._box_indices[row]
+            column=indices.index(column) if column in indices else len(indices)
+
+        return row-self._start, column
+
+    def needs_move(self, row):
+        return (row<self._start+TextWindow.MARGIN and self._start>0) or (row>=self.end-TextWindow.MARGIN and self.end<len(self._lines))
+    def move_to(self, row):
+        self._start=max(0, min(row-TextWindow.SIZE//2, len(self._lines)-TextWindow.SIZE))
 
 class MainWindow(wx.Frame):
 
     OPEN_MENU_ITEM_ID=1
+    OPEN_PROJECT_MENU_ITEM_ID=2
+    SAVE_PROJECT_MENU_ITEM_ID=3
+    SAVE_PROJECT_AS_MENU_ITEM_ID=4
+    PREVIOUS_PAGE_MENU_ITEM_ID=5
+    NEXT_PAGE_MENU_ITEM_ID=6
 
     PLACE_LEFT_BORDER_MENU_ITEM_ID=31
     PLACE_RIGHT_BORDER_MENU_ITEM_ID=32
@@ -763,6 +3879,8 @@ class MainWindow(wx.Frame):
     SWITCH_HORIZONTAL_BORDERS_MENU_ITEM_ID=40
     SWITCH_VERTICAL_BORDERS_MENU_ITEM_ID=41
 
+    BORDER_NEXT_FORMULA_CANDIDATE_MENU_ITEM_ID=42
+
     LEFT_EDGE_DISTANCE_MENU_ITEM_ID=51
     RIGHT_EDGE_DISTANCE_MENU_ITEM_ID=52
     TOP_EDGE_DISTANCE_MENU_ITEM_ID=53
@@ -771,38 +3889,64 @@ class MainWindow(wx.Frame):
     BORDERED_REGION_HEIGHT_MENU_ITEM_ID=56
     CHARACTER_WIDTH_MENU_ITEM_ID=57
     CHARACTER_HEIGHT_MENU_ITEM_ID=58
+    SKEW_ANGLE_MENU_ITEM_ID=59
+    INDENTATION_MENU_ITEM_ID=60
+    LINE_SPACING_MENU_ITEM_ID=61
+    MARGINS_MENU_ITEM_ID=62
+    ANNOUNCE_LAYOUT_CHANGES_MENU_ITEM_ID=63
 
     RECOGNIZE_BORDERED_REGION_MENU_ITEM_ID=71
     SAVE_BORDERED_REGION_MENU_ITEM_ID=72
+    REFINE_BORDERED_REGION_MENU_ITEM_ID=73
+    RECOGNITION_STATISTICS_MENU_ITEM_ID=74
 
     SPLIT_TO_COLUMNS_MENU_ITEM_ID=101
     SWITCH_TO_PREVIOUS_COLUMN_MENU_ITEM_ID=102
     SWITCH_TO_NEXT_COLUMN_MENU_ITEM_ID=103
     CANCEL_COLUMNS_MENU_ITEM_ID=104
+    COLUMNS_MEMORY_USAGE_MENU_ITEM_ID=105
+    DETECT_COLUMNS_MENU_ITEM_ID=106
+    SPLIT_TO_DETECTED_COLUMNS_MENU_ITEM_ID=107
 
-    def __init__(self):
+    MEMORY_REPORT_MENU_ITEM_ID=121
+    PROFILING_MENU_ITEM_ID=122
+    SCHEDULER_METRICS_MENU_ITEM_ID=123
+
+    def __init__(self, file_path=None, profile_directory=None):
         super().__init__(parent=None)
 
         self._settings=Settings()
         self._load_settings()
 
         if platform.system()=="Linux":
-            self._speech=LinuxSpeech()
+            self._speech=SpeechQueue(LinuxSpeech())
         elif platform.system()=="Windows":
-            self._speech=WindowsSpeech()
+            self._speech=SpeechQueue(WindowsSpeech())
 
         self._math_scanner=MathScanner(self._settings)
+        self._profile_directory=profile_directory
+        if profile_directory!=None:
+            self._math_scanner.start_profiling(profile_directory)
 
         self._setup_interface()
 
         self._set_window_title()
 
-        args=sys.argv
-        if len(args)==2:
-            self._open_image(args[1])
+        if file_path!=None:
+            self._open_image(file_path)
     def _setup_interface(self):
 
         self._image_text_TextCtrl=wx.TextCtrl(self, style=wx.TE_MULTILINE | wx.TE_READONLY | wx.TE_DONTWRAP)
+        self._image_text_TextCtrl.Bind(wx.EVT_KEY_UP, self._image_text_key_up)
+
+        self._text_windows=OrderedDict() # Ids of the views' boxes: boxes and their text windows
+        self._text_window=None
+
+        self._formula_candidate_view=None # Boxes of the view the candidates were last cycled in
+        self._formula_candidate_index=-1
+
+        self._announce_layout_changes=False
+        self._caret_row=0
 
         menu_bar=wx.MenuBar()
         menu_bar.Append(self._construct_file_menu(), "&File")
@@ -820,11 +3964,21 @@ class MainWindow(wx.Frame):
         file_menu=wx.Menu()
 
         file_menu.Append(MainWindow.OPEN_MENU_ITEM_ID, "Open\tCtrl+O")
+        file_menu.Append(MainWindow.OPEN_PROJECT_MENU_ITEM_ID, "Open project\tCtrl+Shift+O")
+        file_menu.Append(MainWindow.SAVE_PROJECT_MENU_ITEM_ID, "Save project\tCtrl+S")
+        file_menu.Append(MainWindow.SAVE_PROJECT_AS_MENU_ITEM_ID, "Save project as")
+        file_menu.Append(MainWindow.PREVIOUS_PAGE_MENU_ITEM_ID, "Previous page\tCtrl+PgUp")
+        file_menu.Append(MainWindow.NEXT_PAGE_MENU_ITEM_ID, "Next page\tCtrl+PgDn")
         file_menu.Append(wx.ID_EXIT, "Exit")
 
         # Events
 
         self.Bind(wx.EVT_MENU, self._open_menu_item_click, id=MainWindow.OPEN_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._open_project_menu_item_click, id=MainWindow.OPEN_PROJECT_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._save_project_menu_item_click, id=MainWindow.SAVE_PROJECT_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._save_project_as_menu_item_click, id=MainWindow.SAVE_PROJECT_AS_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._previous_page_menu_item_click, id=MainWindow.PREVIOUS_PAGE_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._next_page_menu_item_click, id=MainWindow.NEXT_PAGE_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._exit_menu_item_click, id=wx.ID_EXIT)
 
         return file_menu
@@ -847,6 +4001,8 @@ class MainWindow(wx.Frame):
         borders_menu.Append(MainWindow.SWITCH_HORIZONTAL_BORDERS_MENU_ITEM_ID, "Switch horizontal borders")
         borders_menu.Append(MainWindow.SWITCH_VERTICAL_BORDERS_MENU_ITEM_ID, "Switch vertical borders")
 
+        borders_menu.Append(MainWindow.BORDER_NEXT_FORMULA_CANDIDATE_MENU_ITEM_ID, "Border next formula candidate\tCtrl+F")
+
         # Events
 
         self.Bind(wx.EVT_MENU, self._place_left_border_menu_item_click, id=MainWindow.PLACE_LEFT_BORDER_MENU_ITEM_ID)
@@ -864,22 +4020,30 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self._switch_horizontal_borders_menu_item_click, id=MainWindow.SWITCH_HORIZONTAL_BORDERS_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._switch_vertical_borders_menu_item_click, id=MainWindow.SWITCH_VERTICAL_BORDERS_MENU_ITEM_ID)
 
+        self.Bind(wx.EVT_MENU, self._border_next_formula_candidate_menu_item_click, id=MainWindow.BORDER_NEXT_FORMULA_CANDIDATE_MENU_ITEM_ID)
+
         return borders_menu
     def _construct_columns_menu(self):
 
         columns_menu=wx.Menu()
 
         columns_menu.Append(MainWindow.SPLIT_TO_COLUMNS_MENU_ITEM_ID, "Split to columns")
+        columns_menu.Append(MainWindow.DETECT_COLUMNS_MENU_ITEM_ID, "Detect columns")
+        columns_menu.Append(MainWindow.SPLIT_TO_DETECTED_COLUMNS_MENU_ITEM_ID, "Split to detected columns\tCtrl+Shift+S")
         columns_menu.Append(MainWindow.SWITCH_TO_PREVIOUS_COLUMN_MENU_ITEM_ID, "Switch to previous column\tAlt+Left")
         columns_menu.Append(MainWindow.SWITCH_TO_NEXT_COLUMN_MENU_ITEM_ID, "Switch to next column\tAlt+Right")
         columns_menu.Append(MainWindow.CANCEL_COLUMNS_MENU_ITEM_ID, "Cancel columns")
+        columns_menu.Append(MainWindow.COLUMNS_MEMORY_USAGE_MENU_ITEM_ID, "Columns memory usage")
 
         # Events
 
         self.Bind(wx.EVT_MENU, self._split_to_columns_menu_item_click, id=MainWindow.SPLIT_TO_COLUMNS_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._detect_columns_menu_item_click, id=MainWindow.DETECT_COLUMNS_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._split_to_detected_columns_menu_item_click, id=MainWindow.SPLIT_TO_DETECTED_COLUMNS_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._switch_to_previous_column_menu_item_click, id=MainWindow.SWITCH_TO_PREVIOUS_COLUMN_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._switch_to_next_column_menu_item_click, id=MainWindow.SWITCH_TO_NEXT_COLUMN_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._cancel_columns_menu_item_click, id=MainWindow.CANCEL_COLUMNS_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._columns_memory_usage_menu_item_click, id=MainWindow.COLUMNS_MEMORY_USAGE_MENU_ITEM_ID)
 
         return columns_menu
     def _construct_say_menu(self):
@@ -895,6 +4059,12 @@ class MainWindow(wx.Frame):
         say_menu.Append(MainWindow.BORDERED_REGION_HEIGHT_MENU_ITEM_ID, "Bordered region height\tCtrl+H")
         say_menu.Append(MainWindow.CHARACTER_WIDTH_MENU_ITEM_ID, "Character width\tCtrl+Shift+W")
         say_menu.Append(MainWindow.CHARACTER_HEIGHT_MENU_ITEM_ID, "Character Height\tCtrl+Shift+H")
+        say_menu.Append(MainWindow.SKEW_ANGLE_MENU_ITEM_ID, "Skew angle")
+
+        say_menu.Append(MainWindow.INDENTATION_MENU_ITEM_ID, "Indentation\tCtrl+Shift+I")
+        say_menu.Append(MainWindow.LINE_SPACING_MENU_ITEM_ID, "Line spacing\tCtrl+Shift+G")
+        say_menu.Append(MainWindow.MARGINS_MENU_ITEM_ID, "Margins\tCtrl+Shift+M")
+        say_menu.AppendCheckItem(MainWindow.ANNOUNCE_LAYOUT_CHANGES_MENU_ITEM_ID, "Announce layout changes")
 
         self.Bind(wx.EVT_MENU, self._left_edge_distance_menu_item_click, id=MainWindow.LEFT_EDGE_DISTANCE_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._right_edge_distance_menu_item_click, id=MainWindow.RIGHT_EDGE_DISTANCE_MENU_ITEM_ID)
@@ -905,6 +4075,12 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self._bordered_region_height_menu_item_click, id=MainWindow.BORDERED_REGION_HEIGHT_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._character_width_menu_item_click, id=MainWindow.CHARACTER_WIDTH_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._character_height_menu_item_click, id=MainWindow.CHARACTER_HEIGHT_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._skew_angle_menu_item_click, id=MainWindow.SKEW_ANGLE_MENU_ITEM_ID)
+
+        self.Bind(wx.EVT_MENU, self._indentation_menu_item_click, id=MainWindow.INDENTATION_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._line_spacing_menu_item_click, id=MainWindow.LINE_SPACING_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._margins_menu_item_click, id=MainWindow.MARGINS_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._announce_layout_changes_menu_item_click, id=MainWindow.ANNOUNCE_LAYOUT_CHANGES_MENU_ITEM_ID)
 
         return say_menu
     def _construct_recognition_menu(self):
@@ -913,26 +4089,39 @@ class MainWindow(wx.Frame):
 
         recognition_menu.Append(MainWindow.RECOGNIZE_BORDERED_REGION_MENU_ITEM_ID, "Recognize bordered region")
         recognition_menu.Append(MainWindow.SAVE_BORDERED_REGION_MENU_ITEM_ID, "Save bordered region")
+        recognition_menu.Append(MainWindow.REFINE_BORDERED_REGION_MENU_ITEM_ID, "Refine bordered region\tCtrl+Shift+F")
+        recognition_menu.Append(MainWindow.RECOGNITION_STATISTICS_MENU_ITEM_ID, "Recognition statistics")
 
         # Events
 
         self.Bind(wx.EVT_MENU, self._recognize_bordered_region_menu_item_click, id=MainWindow.RECOGNIZE_BORDERED_REGION_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._save_bordered_region_menu_item_click, id=self.SAVE_BORDERED_REGION_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._refine_bordered_region_menu_item_click, id=MainWindow.REFINE_BORDERED_REGION_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._recognition_statistics_menu_item_click, id=MainWindow.RECOGNITION_STATISTICS_MENU_ITEM_ID)
 
         return recognition_menu
     def _construct_help_menu(self):
 
         help_menu=wx.Menu()
 
+        help_menu.Append(MainWindow.MEMORY_REPORT_MENU_ITEM_ID, "Memory report")
+        help_menu.Append(MainWindow.SCHEDULER_METRICS_MENU_ITEM_ID, "Job queues")
+        help_menu.AppendCheckItem(MainWindow.PROFILING_MENU_ITEM_ID, "Profiling")
+        help_menu.Check(MainWindow.PROFILING_MENU_ITEM_ID, self._math_scanner.is_profiling)
         help_menu.Append(wx.ID_ABOUT, "About")
 
         # Events
 
+        self.Bind(wx.EVT_MENU, self._memory_report_menu_item_click, id=MainWindow.MEMORY_REPORT_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._scheduler_metrics_menu_item_click, id=MainWindow.SCHEDULER_METRICS_MENU_ITEM_ID)
+        self.Bind(wx.EVT_MENU, self._profiling_menu_item_click, id=MainWindow.PROFILING_MENU_ITEM_ID)
         self.Bind(wx.EVT_MENU, self._about_menu_item_click, id=wx.ID_ABOUT)
 
         return help_menu
     def _set_window_title(self):
         title=f"{self._math_scanner.file_name} - Math scanner" if not self._math_scanner.has_columns else f"{self._math_scanner.file_name} {self._math_scanner.active_column_index+1}/{self._math_scanner.column_count} - Math scanner"
+        if self._math_scanner.project_path!=None:
+            title=f"{path.basename(self._math_scanner.project_path)} page {self._math_scanner.page_number+1}/{self._math_scanner.page_count}, {title}"
         self.SetTitle(title)
 
     # Event methods
@@ -947,99 +4136,176 @@ class MainWindow(wx.Frame):
             path=file_dialog.GetPath()
 
             self._open_image(path)
+    def _open_project_menu_item_click(self, event):
+
+        with wx.FileDialog(self, "Open a project", wildcard="Math scanner projects (*.msproj)|*.msproj", style=wx.FD_OPEN|wx.FD_FILE_MUST_EXIST) as file_dialog:
+
+            if file_dialog.ShowModal()==wx.ID_CANCEL:
+                return
+
+            try:
+                self._math_scanner.open_project(file_dialog.GetPath())
+                self._show_text()
+                self._set_window_title()
+                self._announce_page_recognized_again()
+            except (FileNotFoundError, ValueError) as e:
+                wx.MessageBox(str(e), caption="Error", style=wx.CENTRE | wx.ICON_ERROR)
+    def _save_project_menu_item_click(self, event):
+        if self._math_scanner.project_path==None:
+            self._save_project_as_menu_item_click(event)
+        elif self._math_scanner.image!=None:
+            self._math_scanner.save_project(self._math_scanner.project_path)
+            self._speech.speak("Saved")
+    def _save_project_as_menu_item_click(self, event):
+        if self._math_scanner.image==None:
+            return
+
+        with wx.FileDialog(self, "Save project", wildcard="Math scanner projects (*.msproj)|*.msproj", style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT) as file_dialog:
+
+            if file_dialog.ShowModal()==wx.ID_CANCEL:
+                return
+
+            self._math_scanner.save_project(file_dialog.GetPath())
+            self._set_window_title()
+    def _previous_page_menu_item_click(self, event):
+        if self._math_scanner.page_number>0:
+            self._switch_to_page(self._math_scanner.page_number-1)
+    def _next_page_menu_item_click(self, event):
+        if self._math_scanner.page_number<self._math_scanner.page_count-1:
+            self._switch_to_page(self._math_scanner.page_number+1)
     def _exit_menu_item_click(self, event):
         self.Close()
 
     def _place_left_border_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
+        row, column=self._caret_coordinates()
 
         try:
             if self._math_scanner.place_left_border(row, column):
-                self._speech.speak("Set")
+                self._speech.speak("Set", kind="borders")
         except ValueError:
-            self._speech.speak("Invalid coordinates")
+            self._speech.speak("Invalid coordinates", kind="borders")
     def _place_right_border_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
+        row, column=self._caret_coordinates()
 
         try:
             if self._math_scanner.place_right_border(row, column):
-                self._speech.speak("Set")
+                self._speech.speak("Set", kind="borders")
         except ValueError:
-            self._speech.speak("Invalid coordinates")
+            self._speech.speak("Invalid coordinates", kind="borders")
     def _place_top_border_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
+        row, column=self._caret_coordinates()
 
         try:
             if self._math_scanner.place_top_border(row, column):
-                self._speech.speak("Set")
+                self._speech.speak("Set", kind="borders")
         except ValueError:
-            self._speech.speak("Invalid coordinates")
+            self._speech.speak("Invalid coordinates", kind="borders")
     def _place_bottom_border_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
+        row, column=self._caret_coordinates()
 
         try:
             if self._math_scanner.place_bottom_border(row, column):
-                self._speech.speak("Set")
+                self._speech.speak("Set", kind="borders")
         except ValueError:
-            self._speech.speak("Invalid coordinates")
+            self._speech.speak("Invalid coordinates", kind="borders")
 
     def _remove_left_border_menu_item_click(self, event):
 
         if self._math_scanner.remove_left_border():
-            self._speech.speak("Removed")
+            self._speech.speak("Removed", kind="borders")
     def _remove_right_border_menu_item_click(self, event):
 
         if self._math_scanner.remove_right_border():
-            self._speech.speak("Removed")
+            self._speech.speak("Removed", kind="borders")
     def _remove_top_border_menu_item_click(self, event):
 
         if self._math_scanner.remove_top_border():
-            self._speech.speak("Removed")
+            self._speech.speak("Removed", kind="borders")
     def _remove_bottom_border_menu_item_click(self, event):
 
         if self._math_scanner.remove_bottom_border():
-            self._speech.speak("Removed")
+            self._speech.speak("Removed", kind="borders")
 
     def _remove_all_borders_menu_item_click(self, event):
         if self._math_scanner.remove_all_borders():
-            self._speech.speak("Removed all")
+            self._speech.speak("Removed all", kind="borders")
 
     def _switch_horizontal_borders_menu_item_click(self, event):
         self._math_scanner.switch_horizontal_borders()
 
-        self._speech.speak("Switched")
+        self._speech.speak("Switched", kind="borders")
     def _switch_vertical_borders_menu_item_click(self, event):
         self._math_scanner.switch_vertical_borders()
 
-        self._speech.speak("Switched")
+        self._speech.speak("Switched", kind="borders")
+
+    def _border_next_formula_candidate_menu_item_click(self, event):
+        if self._math_scanner.image==None:
+            return
+
+        candidates=self._math_scanner.formula_candidates()
+        if len(candidates)==0:
+            self._speech.speak("No formula candidates", kind="borders")
+            return
+
+        # Candidates are cycled in the order of their score, starting again with each new view
+
+        if self._formula_candidate_view is not self._math_scanner.image_boxes:
+            self._formula_candidate_view=self._math_scanner.image_boxes
+            self._formula_candidate_index=-1
+        self._formula_candidate_index=(self._formula_candidate_index+1)%len(candidates)
+
+        candidate=self._math_scanner.border_formula_candidate(self._formula_candidate_index)
+        lines=f"line {candidate.first_row+1}" if candidate.first_row==candidate.last_row else f"lines {candidate.first_row+1} to {candidate.last_row+1}"
 
+        self._speech.speak(f"Candidate {self._formula_candidate_index+1} of {len(candidates)}, {lines}", kind="borders")
     def _left_edge_distance_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
-        self._speech.speak(f"{self._math_scanner.left_edge_distance(row, column)}%")
+        row, column=self._caret_coordinates()
+        self._speech.speak(f"{self._math_scanner.left_edge_distance(row, column)}%", kind="measures")
     def _right_edge_distance_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
-        self._speech.speak(f"{self._math_scanner.right_edge_distance(row, column)}%")
+        row, column=self._caret_coordinates()
+        self._speech.speak(f"{self._math_scanner.right_edge_distance(row, column)}%", kind="measures")
     def _top_edge_distance_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
-        self._speech.speak(f"{self._math_scanner.top_edge_distance(row, column)}%")
+        row, column=self._caret_coordinates()
+        self._speech.speak(f"{self._math_scanner.top_edge_distance(row, column)}%", kind="measures")
     def _bottom_edge_distance_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
-        self._speech.speak(f"{self._math_scanner.bottom_edge_distance(row, column)}%")
+        row, column=self._caret_coordinates()
+        self._speech.speak(f"{self._math_scanner.bottom_edge_distance(row, column)}%", kind="measures")
     def _bordered_region_width_menu_item_click(self, event):
-        self._speech.speak(f"{self._math_scanner.bordered_region_width()}")
+        self._speech.speak(f"{self._math_scanner.bordered_region_width()}", kind="measures")
     def _bordered_region_height_menu_item_click(self, event):
-        self._speech.speak(f"{self._math_scanner.bordered_region_height()}")
+        self._speech.speak(f"{self._math_scanner.bordered_region_height()}", kind="measures")
     def _character_width_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
-        self._speech.speak(f"{self._math_scanner.character_width(row, column)}")
+        row, column=self._caret_coordinates()
+        self._speech.speak(f"{self._math_scanner.character_width(row, column)}", kind="measures")
     def _character_height_menu_item_click(self, event):
-        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
-        self._speech.speak(f"{self._math_scanner.character_height(row, column)}")
+        row, column=self._caret_coordinates()
+        self._speech.speak(f"{self._math_scanner.character_height(row, column)}", kind="measures")
+    def _skew_angle_menu_item_click(self, event):
+        skew_angle=self._math_scanner.skew_angle
+
+        self._speech.speak(f"{skew_angle} degrees" if skew_angle!=None else "Not measured", kind="measures")
+    def _indentation_menu_item_click(self, event):
+        row, _=self._caret_coordinates()
+        level, count=self._math_scanner.indentation(row)
+
+        self._speech.speak(f"Level {level} of {count}", kind="measures")
+    def _line_spacing_menu_item_click(self, event):
+        row, _=self._caret_coordinates()
+        spacing=self._math_scanner.line_spacing(row)
+
+        self._speech.speak(f"{spacing:.1f} lines" if spacing!=None else "First line", kind="measures")
+    def _margins_menu_item_click(self, event):
+        left, right, top, bottom=self._math_scanner.margins()
+
+        self._speech.speak(f"Left {left}%, right {right}%, top {top}%, bottom {bottom}%", kind="measures")
+    def _announce_layout_changes_menu_item_click(self, event):
+        self._announce_layout_changes=event.IsChecked()
 
     def _recognize_bordered_region_menu_item_click(self, event):
-        img=self._math_scanner.get_bordered_region()
+        region=self._math_scanner.get_bordered_region()
 
-        json_response=self._math_scanner.recognize(img)
+        json_response=self._math_scanner.recognize(region)
 
         response=json.loads(json_response)
 
@@ -1056,8 +4322,12 @@ class MainWindow(wx.Frame):
         else:
             title="Result"
 
+            if "tier" in response:
+                message+=f"Recognized by: {response['tier']}\n"
             if "latex_confidence" in response:
                 message+=f"LaTeX confidence: {response['latex_confidence']}\n"
+            if "text" in response:
+                message+=f"Text: {response['text']}\n"
             if "asciimath" in response:
                 message+=f"Asciimath: {response['asciimath']}\n"
             if "latex_simplified" in response:
@@ -1075,61 +4345,274 @@ class MainWindow(wx.Frame):
             if file_dialog.ShowModal()==wx.ID_CANCEL:
                 return
 
-            img=self._math_scanner.get_bordered_region()
+            region=self._math_scanner.get_bordered_region()
             path=file_dialog.GetPath()
 
-            img.save(path, format="png")
+            region.save(path, format="png")
+    def _refine_bordered_region_menu_item_click(self, event):
+        if self._math_scanner.image==None:
+            return
+
+        caret=self._caret_coordinates()
+
+        count=self._math_scanner.refine_bordered_region()
+        self._show_text(caret)
+
+        self._speech.speak(f"Refined, {count} characters")
+    def _recognition_statistics_menu_item_click(self, event):
+        try:
+            statistics=self._math_scanner.recognition_statistics()
+        except DaemonError as e:
+            wx.MessageBox(str(e), caption="Error", style=wx.CENTRE | wx.ICON_ERROR)
+            return
+
+        message="\n".join([f"{tier}: {s['requests']} requests, {s['accepted']} accepted, {s['escalated']} escalated, average latency {s['average latency']:.2f} s, spend {s['spend']:.3f}" for tier, s in statistics.items()])
+
+        wx.MessageBox(message, caption="Recognition statistics", style=wx.CENTRE | wx.ICON_INFORMATION)
 
     def _split_to_columns_menu_item_click(self, event):
         self._math_scanner.split_to_columns()
-        self._image_text_TextCtrl.SetValue(self._math_scanner.image_text)
+        self._show_text()
         self._set_window_title()
+    def _detect_columns_menu_item_click(self, event):
+        if self._math_scanner.image!=None:
+            self._speech.speak(f"{len(self._math_scanner.detect_columns())+1} columns")
+    def _split_to_detected_columns_menu_item_click(self, event):
+        if self._math_scanner.image==None:
+            return
+
+        if self._math_scanner.split_to_detected_columns():
+            self._show_text()
+            self._set_window_title()
+        else:
+            self._speech.speak("No columns detected")
     def _switch_to_previous_column_menu_item_click(self, event):
         if self._math_scanner.has_columns:
             self._math_scanner.switch_to_previous_column()
-            self._image_text_TextCtrl.SetValue(self._math_scanner.image_text)
+            self._show_text()
             self._set_window_title()
     def _switch_to_next_column_menu_item_click(self, event):
         if self._math_scanner.has_columns:
             self._math_scanner.switch_to_next_column()
-            self._image_text_TextCtrl.SetValue(self._math_scanner.image_text)
+            self._show_text()
             self._set_window_title()
     def _cancel_columns_menu_item_click(self, event):
         self._math_scanner.cancel_columns()
-        self._image_text_TextCtrl.SetValue(self._math_scanner.image_text)
+        self._show_text()
         self._set_window_title()
-
+    def _columns_memory_usage_menu_item_click(self, event):
+        self._speech.speak(f"{self._math_scanner.column_count} columns, {round(self._math_scanner.columns_memory_usage()/1024)} kilobytes")
+
+    def _memory_report_menu_item_click(self, event):
+        wx.MessageBox(self._math_scanner.format_memory_report(), caption="Memory report", style=wx.CENTRE | wx.ICON_INFORMATION)
+    def _scheduler_metrics_menu_item_click(self, event):
+        message="\n".join([f"{name}: {m['waiting']} waiting, {m['running']} running, {m['completed']} completed, average wait {m['average wait']:.2f} s, maximum wait {m['maximum wait']:.2f} s" for name, m in self._math_scanner.scheduler_metrics().items()])
+
+        wx.MessageBox(message, caption="Job queues", style=wx.CENTRE | wx.ICON_INFORMATION)
+    def _profiling_menu_item_click(self, event):
+        if not self._math_scanner.is_profiling:
+            self._math_scanner.start_profiling(self._profile_directory)
+            self._speech.speak("Profiling started, repeat the slow operation and then stop the profiling")
+            return
+
+        self._write_profile()
     def _about_menu_item_click(self, event):
         wx.MessageBox("Math scanner 1.0\nCopyleft 2021 Rastislav Kish\nThis program is licensed under the terms of the GNU General Public License version 3.", caption="About", style=wx.CENTRE | wx.ICON_INFORMATION)
 
+    def _image_text_key_up(self, event):
+
+        # When the caret approaches an edge of the text window, the window moves to have it in the middle
+
+        if self._text_window!=None:
+            row, column=self._caret_coordinates()
+
+            if self._text_window.needs_move(row):
+                self._text_window.move_to(row)
+                self._show_text((row, column))
+
+            # The layout map makes the comparison cheap enough for every key press
+
+            if self._announce_layout_changes and row!=self._caret_row:
+                changes=self._math_scanner.layout_changes(self._caret_row, row)
+                if len(changes)>0:
+                    self._speech.speak(", ".join(changes), kind="layout", priority=SpeechQueue.LOW)
+            self._caret_row=row
+
+        event.Skip()
+
     def _main_window_close(self, event):
+        if self._math_scanner.is_profiling:
+            self._write_profile()
+
         self._speech.release()
+        self._math_scanner.close()
 
         event.Skip()
 
     # Helper methods
+    def _write_profile(self):
+        try:
+            bundle_path=self._math_scanner.stop_profiling()
+            wx.MessageBox(f"The profile was saved to {bundle_path}. Please send this file along with the description of the problem.", caption="Profiling", style=wx.CENTRE | wx.ICON_INFORMATION)
+        except OSError as e:
+            wx.MessageBox(f"The profile could not be saved. {e}", caption="Error", style=wx.CENTRE | wx.ICON_ERROR)
 
     def _open_image(self, path):
         try:
             self._math_scanner.load_image_from_file(path)
-            self._image_text_TextCtrl.SetValue(self._math_scanner.image_text)
+            self._show_text()
             self._set_window_title()
         except FileNotFoundError:
             wx.MessageBox(f"File {path} can't be found.", caption="Error", style=wx.CENTRE | wx.ICON_ERROR)
-    def _load_settings(self):
-        candidates=[
-            path.join(appdirs.user_config_dir("math_scanner"), "settings.yaml"),
-            "settings.yaml",
-            ]
+    def _show_text(self, caret=None):
 
-        for p in candidates:
-            if path.exists(p):
-                self._settings.load(p)
-                break
+        # Only a window of the view's text is passed to the control. Each view keeps its window and caret, so returning to it restores both
+
+        if self._text_window!=None:
+            self._text_window.caret=self._caret_coordinates()
+
+        boxes=self._math_scanner.image_boxes
+        entry=self._text_windows.get(id(boxes))
+        if entry==None or entry[0] is not boxes:
+            entry=(boxes, TextWindow(boxes))
+            self._text_windows[id(boxes)]=entry
+
+            while len(self._text_windows)>16:
+                self._text_windows.popitem(last=False)
+
+        self._text_window=entry[1]
+        if caret!=None:
+            self._text_window.caret=caret
+
+        row, column=self._text_window.caret
+        if row<self._text_window.start or row>=self._text_window.end:
+            self._text_window.move_to(row)
+
+        window_row, window_column=self._text_window.to_window(row, column)
+        self._image_text_TextCtrl.ChangeValue(self._text_window.text())
+        self._image_text_TextCtrl.SetInsertionPoint(max(0, self._image_text_TextCtrl.XYToPosition(window_column, window_row)))
+
+        self._announce_daemon_error()
+    def _caret_coordinates(self):
+        _, column, row=self._image_text_TextCtrl.PositionToXY(self._image_text_TextCtrl.GetInsertionPoint())
+
+        return self._text_window.to_boxes(row, column) if self._text_window!=None else (row, column)
+    def _switch_to_page(self, page_number):
+        try:
+            self._math_scanner.switch_to_page(page_number)
+            self._show_text()
+            self._set_window_title()
+            self._announce_page_recognized_again()
+        except FileNotFoundError as e:
+            wx.MessageBox(f"Image {e.filename} of the page can't be found.", caption="Error", style=wx.CENTRE | wx.ICON_ERROR)
+    def _announce_daemon_error(self):
+        message=self._math_scanner.take_daemon_error()
+
+        if message!=None:
+            self._speech.speak(f"The daemon failed, the text was recognized locally. {message}")
+    def _announce_page_recognized_again(self):
+        if self._math_scanner.page_recognized_again:
+            self._speech.speak("The image settings changed since the page was saved, so it was recognized again and its columns and borders were removed")
+    def _load_settings(self):
+        self._settings.load_from_default_locations()
 
 if __name__=="__main__":
+    parser=argparse.ArgumentParser(prog="math_scanner", description="Reading and recognition of mathematical expressions in images.")
+    parser.add_argument("file", nargs="?", help="an image to open")
+    parser.add_argument("--daemon", action="store_true", help="run the recognition daemon instead of the interface")
+    parser.add_argument("--watch", metavar="FOLDER", help="recognize images appearing in the given folder in advance instead of running the interface")
+    parser.add_argument("--memory-report", action="store_true", help="print the memory used after loading the file instead of running the interface")
+    parser.add_argument("--batch", metavar="OUTPUT_FOLDER", help="recognize the given files and write the results to the folder instead of running the interface, continuing an interrupted run")
+    parser.add_argument("batch_files", nargs="*", metavar="file", help="further images to process with --batch")
+    parser.add_argument("--profile", metavar="FOLDER", help="profile loading, splitting and recognition, saving the profile to the given folder at the end. The MATH_SCANNER_PROFILE environment variable does the same")
+    args=parser.parse_args()
+
+    profile_directory=args.profile if args.profile!=None else os.environ.get("MATH_SCANNER_PROFILE")
+
+    if args.batch!=None:
+        settings=Settings()
+        settings.load_from_default_locations()
+
+        math_scanner=MathScanner(settings)
+        if profile_directory!=None:
+            math_scanner.start_profiling(profile_directory)
+        sink=ResultSink(args.batch)
+        files=([args.file] if args.file!=None else [])+args.batch_files
+
+        failed=0
+
+        try:
+            for i, file_path in enumerate(files):
+                try:
+                    key=PageStore.key(file_path, settings)
+                    if sink.is_completed(key):
+                        continue
+
+                    math_scanner.load_image_from_file(file_path, Scheduler.BATCH)
+                except (OSError, ValueError, pytesseract.TesseractError, Image.DecompressionBombError) as e:
+                    print(f"{file_path}: {e}", file=sys.stderr)
+                    failed+=1
+                    continue
+
+                sink.add(key, math_scanner.page_result())
+                print(f"{i+1}/{len(files)} {path.basename(file_path)}")
+        finally:
+            sink.close()
+            if profile_directory!=None:
+                print(f"Profile saved to {math_scanner.stop_profiling()}")
+
+        if failed>0:
+            print(f"{failed} of {len(files)} files failed.", file=sys.stderr)
+        sys.exit(1 if failed>0 else 0)
+
+    if args.memory_report:
+        settings=Settings()
+        settings.load_from_default_locations()
+
+        math_scanner=MathScanner(settings)
+        math_scanner.start_memory_tracing()
+        if profile_directory!=None:
+            math_scanner.start_profiling(profile_directory)
+        if args.file!=None:
+            math_scanner.load_image_from_file(args.file)
+
+        print(math_scanner.format_memory_report())
+        if profile_directory!=None:
+            print(f"Profile saved to {math_scanner.stop_profiling()}")
+        sys.exit(0)
+
+    if args.watch!=None:
+        settings=Settings()
+        settings.load_from_default_locations()
+
+        def report(file_path, lag):
+            print(f"{path.basename(file_path)} processed in {lag:.1f} s, {watcher.queue_depth} waiting, lag {watcher.lag:.1f} s")
+
+        page_store=PageStore(settings.cache_configuration.directory, settings.cache_configuration.size)
+        page_index=PageIndex(page_store.directory) if settings.cache_configuration.near_duplicates else None
+
+        watcher=FolderWatcher(args.watch, settings, page_store, page_index, on_processed=report)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.daemon:
+        settings=Settings()
+        settings.load_from_default_locations()
+
+        try:
+            RecognitionDaemon(settings).serve_forever()
+        except (OSError, ValueError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     app=wx.App(False)
-    main_window=MainWindow()
+    main_window=MainWindow(args.file, profile_directory)
     main_window.Show(True)
     app.MainLoop()
 